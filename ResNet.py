@@ -1,10 +1,33 @@
+from contextlib import contextmanager, nullcontext
+
 import torch
 import torch.nn as nn
+from torch.utils.checkpoint import checkpoint
 from torchvision import models
 import torch.nn.functional as F
 
+
+@contextmanager
+def frozen_batchnorm_stats(module):
+    # a checkpointed stage runs its forward twice in training, keep the recomputation from updating batchnorm running stats again
+    norms = [m for m in module.modules() if isinstance(m, nn.modules.batchnorm._BatchNorm)]
+    saved = [(m.momentum, m.num_batches_tracked.clone() if m.num_batches_tracked is not None else None) for m in norms]
+
+    for m in norms:
+        m.momentum = 0.
+
+    try:
+        yield
+    finally:
+        for m, (momentum, num_batches_tracked) in zip(norms, saved):
+            m.momentum = momentum
+            if num_batches_tracked is not None:
+                m.num_batches_tracked.copy_(num_batches_tracked)
+
 class ResUNet(nn.Module):
-    def __init__(self, num_class=100):
+    stage_names = ('encoder1', 'encoder2', 'encoder3', 'encoder4', 'encoder5', 'up1', 'up2', 'up3', 'up4')
+
+    def __init__(self, num_class=100, checkpoint_stages=False):
         super().__init__()
          
         resnet = models.resnet50(weights=models.ResNet50_Weights.IMAGENET1K_V1)
@@ -21,20 +44,48 @@ class ResUNet(nn.Module):
         self.up4 = up_layer_with_attention(256, 64, 64)    
 
         self.last_conv = nn.Conv2d(64, num_class, kernel_size=1)
-    
+
+        self.set_checkpointing(checkpoint_stages)
+
+    def set_checkpointing(self, stages=True):
+        """
+        Recompute the activations of the given stages in the backward pass instead of storing them.
+        stages: True for all, False for none, or names among 'encoder', 'up' (all of either), 'encoder1'-'encoder5', 'up1'-'up4'.
+        """
+        if isinstance(stages, bool):
+            stages = self.stage_names if stages else ()
+        elif isinstance(stages, str):
+            stages = (stages,)
+
+        matches = lambda name, stage: name == stage or name.rstrip('12345') == stage
+
+        unknown = [stage for stage in stages if not any(matches(name, stage) for name in self.stage_names)]
+        assert len(unknown) == 0, f"unknown ResUNet stages {unknown}, must be among {self.stage_names}"
+
+        self.checkpoint_stages = {name for name in self.stage_names if any(matches(name, stage) for stage in stages)}
+
+    def run_stage(self, name, *args):
+        module = getattr(self, name)
+
+        if name not in self.checkpoint_stages or not torch.is_grad_enabled():
+            return module(*args)
+
+        # non-reentrant checkpointing restores the rng state on recomputation, so dropout masks and gradients match the stored run
+        return checkpoint(module, *args, use_reentrant=False, context_fn=lambda: (nullcontext(), frozen_batchnorm_stats(module)))
+
     def forward(self, x):
         # Encoder
-        x1 = self.encoder1(x)
-        x2 = self.encoder2(x1)
-        x3 = self.encoder3(x2)
-        x4 = self.encoder4(x3)
-        x5 = self.encoder5(x4)
+        x1 = self.run_stage('encoder1', x)
+        x2 = self.run_stage('encoder2', x1)
+        x3 = self.run_stage('encoder3', x2)
+        x4 = self.run_stage('encoder4', x3)
+        x5 = self.run_stage('encoder5', x4)
 
         # Decoder
-        x4_up = self.up1(x5, x4)
-        x3_up = self.up2(x4_up, x3)
-        x2_up = self.up3(x3_up, x2)
-        x1_up = self.up4(x2_up, x1)
+        x4_up = self.run_stage('up1', x5, x4)
+        x3_up = self.run_stage('up2', x4_up, x3)
+        x2_up = self.run_stage('up3', x3_up, x2)
+        x1_up = self.run_stage('up4', x2_up, x1)
 
         output = self.last_conv(x1_up)
 
@@ -85,7 +136,8 @@ class SEBlock(nn.Module):
 
     def forward(self, x):
         batch, channels, height, width = x.size()
-        squeeze = x.view(batch, channels, -1).mean(dim=2)
+        # reduce over the spatial dims in place of a view, which only works on contiguous NCHW and not channels_last
+        squeeze = x.mean(dim=(2, 3))
         excitation = self.fc1(squeeze)
         excitation = F.relu(excitation, inplace=True)
         excitation = self.fc2(excitation)
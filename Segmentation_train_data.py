@@ -1,14 +1,27 @@
 """Data utility functions."""
+import hashlib
 import os
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 
 import numpy as np
 import torch
+import torch.nn.functional as F
 import torch.utils.data as data
 from PIL import Image
 from torchvision import transforms
+from tqdm.auto import tqdm
+
+from denoising_diffusion_pytorch.file_manifest import FileManifest
+from denoising_diffusion_pytorch.draft_decode import draft_image
 
 import _pickle as pickle
 
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
 # pylint: disable=C0326
 SEG_LABELS_LIST = [
     {"id": -1, "name": "void",       "rgb_values": [0,     0,    0]},
@@ -217,29 +230,157 @@ SEG_LABELS_LIST2 = [
 	{"id": 99 ,	"name":" flag                ",	"rgb_values": [ 100 ,  48 ,  119 ]}]
 
 
+def build_label_lut(label_list=SEG_LABELS_LIST):
+    """Lookup table from annotation red channel value to class id.
+
+    Values not covered by `label_list` map to themselves, matching the
+    behaviour of the original per-label mask loop.
+    """
+    lut = np.arange(256, dtype=np.int64)
+    for l in label_list:
+        r, g, b = l['rgb_values']
+        if g == 0 and b == 0:
+            lut[r] = l['id']
+    return lut
+
+
+SEG_LABELS_LUT = build_label_lut()
+
+# compact labels are uint8, with the void class (-1) stored as IGNORE_INDEX
+IGNORE_INDEX = 255
+SEG_LABELS_LUT_COMPACT = np.where(SEG_LABELS_LUT < 0, IGNORE_INDEX, SEG_LABELS_LUT).astype(np.uint8)
+
+
+def label_img_to_train_labels(label_img, compact=False):
+    """Decode a single channel (red) annotation image into class ids."""
+    lut = SEG_LABELS_LUT_COMPACT if compact else SEG_LABELS_LUT
+    return lut[np.asarray(label_img, dtype=np.uint8)]
+
+
+def segmentation_cross_entropy(logits, target_labels, **kwargs):
+    """Cross entropy between ResUNet logits and SegmentationtrainData labels.
+
+    Compact uint8 labels are only upcast here, once they have reached the
+    logits' device, and IGNORE_INDEX is ignored. int64 labels ignore the void
+    id (-1) instead.
+    """
+    ignore_index = IGNORE_INDEX if target_labels.dtype == torch.uint8 else -1
+    target_labels = target_labels.to(logits.device, non_blocking=True).long()
+    return F.cross_entropy(logits, target_labels, ignore_index=ignore_index, **kwargs)
+
+
+def build_label_palette(label_list=SEG_LABELS_LIST2):
+    """RGB palette for class ids -1..255, indexed by `id + 1`.
+
+    Ids not in `label_list` are drawn as the gray value of the id, which is
+    what the original per-label masking produced for them.
+    """
+    values = np.arange(-1, 256)
+    palette = np.stack((values, values, values), axis=-1).astype(np.uint8)
+    for l in label_list:
+        palette[l['id'] + 1] = l['rgb_values']
+    return palette
+
+
+SEG_LABELS_PALETTE = build_label_palette()
+
+
 def train_label_img_to_rgb(label_img):
+    """Colorize a (H, W) or (N, H, W) label map with one palette gather.
+
+    Accepts numpy arrays or torch tensors (on any device) and returns the same
+    kind, as uint8 RGB with a trailing channel dimension.
+    """
+    if torch.is_tensor(label_img):
+        label_img = label_img.squeeze()
+        palette = torch.from_numpy(SEG_LABELS_PALETTE).to(label_img.device)
+        return palette[label_img.long().clamp(-1, 255) + 1]
+
     label_img = np.squeeze(label_img)
-    labels = np.unique(label_img)
-    label_infos = [l for l in SEG_LABELS_LIST2 if l['id'] in labels]
+    return SEG_LABELS_PALETTE[np.clip(label_img, -1, 255).astype(np.intp) + 1]
+
+
+def stacked_collate(batch):
+    """collate_fn for DataLoaders over SegmentationtrainData(batched=True).
+
+    With `batched`, `SegmentationtrainData.__getitems__` already returns
+    stacked (images, labels) tensors, so there is nothing left to collate.
+    """
+    return batch
 
-    label_img_rgb = np.array([label_img,
-                              label_img,
-                              label_img]).transpose(1,2,0)
-    for l in label_infos:
-        mask = label_img == l['id']
-        label_img_rgb[mask] = l['rgb_values']
 
-    return label_img_rgb.astype(np.uint8)
+@contextmanager
+def file_lock(path):
+    """Hold an exclusive lock on `path` across processes, where the platform supports it."""
+    with open(path, 'a') as f:
+        if fcntl is not None:
+            fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_UN)
 
 
 class SegmentationtrainData(data.Dataset):
 
-	def __init__(self, image_paths_file):
+	image_size = 256
+	cache_version = 2
+
+	def __init__(self, image_paths_file, cache=False, cache_dir=None, num_threads=None, draft=False, compact_labels=False, use_manifest=False, manifest_path=None, batched=False):
+		self.image_paths_file = image_paths_file
 		self.root_dir_name = os.path.dirname(image_paths_file)
 
 		with open(image_paths_file) as f:
 			self.image_names = f.read().splitlines()
 
+		# decode jpegs near the target size, see draft_image for the error bound
+		self.draft = draft
+
+		# uint8 labels with void as IGNORE_INDEX, use with segmentation_cross_entropy
+		self.compact_labels = compact_labels
+		self.label_lut = SEG_LABELS_LUT_COMPACT if compact_labels else SEG_LABELS_LUT
+
+		self.to_tensor = transforms.ToTensor()
+		self.resize = transforms.Resize((self.image_size, self.image_size))
+		self.target_resize = transforms.Resize((self.image_size, self.image_size), transforms.InterpolationMode.NEAREST)
+
+		# with batched, DataLoader fetches whole batches through get_items, which
+		# needs collate_fn=stacked_collate, otherwise it gets a list of samples
+
+		self.batched = batched
+
+		# thread pool for batched fetches, created lazily in each process
+
+		self.num_threads = num_threads if num_threads is not None else min(8, os.cpu_count() or 1)
+		self.executor = None
+
+		# optional preprocessed store of resized uint8 images and uint8 label
+		# codes, memory mapped so every DataLoader worker reads the same pages
+
+		self.cache = cache
+		self.cache_dir = cache_dir if cache_dir is not None else os.path.splitext(image_paths_file)[0] + '_cache'
+		self.images = None
+		self.labels = None
+
+		# with use_manifest, source file sizes and mtimes come from a FileManifest of the
+		# dataset root, revalidated by directory mtime, instead of one stat per file
+
+		assert not use_manifest or cache, 'use_manifest only applies to the cache fingerprint, it needs cache=True'
+		self.use_manifest = use_manifest
+		self.manifest_path = manifest_path
+
+		if cache:
+			self.build_cache()
+
+	def __getstate__(self):
+		# memmaps are reopened lazily in each worker instead of being pickled
+		state = self.__dict__.copy()
+		state['images'] = None
+		state['labels'] = None
+		state['executor'] = None
+		return state
+
 	def __getitem__(self, key):
 		if isinstance(key, slice):
             # get the start, stop, and step from the slice
@@ -258,45 +399,204 @@ class SegmentationtrainData(data.Dataset):
 	def __len__(self):
 		return len(self.image_names)
 
-	def get_item_from_index(self, index):
-		to_tensor = transforms.ToTensor()
+	def image_rel_path(self, index):
+		img_id = self.image_names[index].replace('.jpg', '')
+		return 'images/' + img_id + '.jpg'
+
+	def target_rel_path(self, index):
 		img_id = self.image_names[index].replace('.jpg', '')
+		return 'annotations_instance/' + img_id + '.png'
+
+	def image_path(self, index):
+		return os.path.join(self.root_dir_name, self.image_rel_path(index))
+
+	def target_path(self, index):
+		return os.path.join(self.root_dir_name, self.target_rel_path(index))
+
+	def decode_item(self, index):
+		"""Load and resize sample `index` from the source files.
+
+		Returns the image as a (H, W, 3) uint8 array and the annotation's red
+		channel as a (H, W) uint8 array of label codes, which `self.label_lut`
+		maps to class ids.
+		"""
+		img = Image.open(self.image_path(index))
+
+		if self.draft:
+			img = draft_image(img, (self.image_size, self.image_size))
 
-		img = Image.open(os.path.join(self.root_dir_name,
-									  'images',
-                                      img_id + '.jpg'))
-		
 		if img.mode != 'RGB':
 			img = img.convert('RGB')
 		#center_crop = transforms.CenterCrop(256)
 		#img = center_crop(img)
-		resize = transforms.Resize((256,256))
-		img = resize(img)
-		img = to_tensor(img)
-
-		target = Image.open(os.path.join(self.root_dir_name,
-										 'annotations_instance',
-                                         img_id + '.png'))
-		if target.mode != 'RGB':
+		img = np.array(self.resize(img))
+
+		target = Image.open(self.target_path(index))
+		if target.mode not in ('RGB', 'L'):
 			target = target.convert('RGB')
-		r, g, b =target.split()
-        #print(b)
-		#Image.new(im1.mode, im1.size, "#000000")  # 黑色
-		e = Image.new('L',target.size,"BLACK")
-        #e = Image.new("RGB",,(0,0,0))
-		target = Image.merge("RGB",(r,e,e))
-		resize = transforms.Resize((256,256),transforms.InterpolationMode.NEAREST)
-		target = resize(target)
+		# only the red channel carries the class, see SEG_LABELS_LIST
+		target = target.getchannel(0)
+		target = self.target_resize(target)
 		#target = center_crop(target)
-		target = np.array(target, dtype=np.int64)
-        
-		target_labels = target[..., 0]
 
-		for label in SEG_LABELS_LIST:
-			mask = np.all(target == label['rgb_values'], axis=2)
-			target_labels[mask] = label['id']
-		#target_labels[target_labels == -1] = 255
+		return img, np.array(target)
+
+	def get_item_from_index(self, index):
+		if self.cache:
+			self.open_cache()
+			img, target = np.array(self.images[index]), self.labels[index]
+		else:
+			img, target = self.decode_item(index)
 
-		target_labels = torch.from_numpy(target_labels.copy())
+		img = self.to_tensor(img)
+		target_labels = torch.from_numpy(self.label_lut[target])
 
 		return img, target_labels
+
+	# batched fetch
+
+	def __getitems__(self, indices):
+		"""Fetch used by DataLoader, batched only when the dataset was created with `batched`."""
+		if self.batched:
+			return self.get_items(indices)
+		return [self[index] for index in indices]
+
+	def empty_batch(self, batch_size):
+		"""Allocate the (images, labels) tensors `get_items` fills."""
+		size = self.image_size
+		label_dtype = torch.uint8 if self.compact_labels else torch.long
+		return torch.empty(batch_size, 3, size, size), torch.empty(batch_size, size, size, dtype=label_dtype)
+
+	def get_items(self, indices):
+		"""Fetch `indices` as stacked (N, 3, H, W) images and (N, H, W) labels.
+
+		Samples are decoded in parallel on a thread pool and written straight
+		into freshly allocated batch tensors, so batches kept by DataLoader
+		workers or pin_memory never share storage.
+		"""
+		indices = [index + len(self) if index < 0 else index for index in indices]
+		for index in indices:
+			if index < 0 or index >= len(self):
+				raise IndexError("The index (%d) is out of range." % index)
+
+		imgs, labels = self.empty_batch(len(indices))
+
+		if self.cache:
+			self.open_cache()
+			imgs.copy_(torch.from_numpy(np.asarray(self.images[indices])).permute(0, 3, 1, 2))
+			labels.copy_(torch.from_numpy(self.label_lut[np.asarray(self.labels[indices])]))
+		else:
+			def fetch(args):
+				i, index = args
+				img, target = self.decode_item(index)
+				imgs[i].copy_(torch.from_numpy(img).permute(2, 0, 1))
+				labels[i].copy_(torch.from_numpy(self.label_lut[target]))
+
+			if self.executor is None:
+				self.executor = ThreadPoolExecutor(self.num_threads)
+
+			list(self.executor.map(fetch, enumerate(indices)))
+
+		# same uint8 -> float conversion as ToTensor, done once for the batch
+		imgs.div_(255)
+
+		return imgs, labels
+
+	# preprocessed cache
+
+	def cache_files(self):
+		return tuple(os.path.join(self.cache_dir, name) for name in ('images.npy', 'labels.npy', 'fingerprint'))
+
+	def source_stats(self):
+		"""(relative path, size, mtime_ns) of every source image and annotation."""
+		rel_paths = [rel_path for index in range(len(self)) for rel_path in (self.image_rel_path(index), self.target_rel_path(index))]
+
+		if not self.use_manifest:
+			for rel_path in rel_paths:
+				st = os.stat(os.path.join(self.root_dir_name, rel_path))
+				yield rel_path, st.st_size, st.st_mtime_ns
+			return
+
+		# the preprocessed cache may live under the dataset root, it is not a source of the dataset
+		root = self.root_dir_name or '.'
+		exclude = [os.path.relpath(self.cache_dir, root)]
+
+		stats = FileManifest(root, self.manifest_path, exclude=exclude).refresh().stats()
+
+		for rel_path in rel_paths:
+			if rel_path not in stats:
+				raise FileNotFoundError(os.path.join(self.root_dir_name, rel_path))
+			yield (rel_path, *stats[rel_path])
+
+	def fingerprint(self):
+		"""Hash of the index file and every source file's size and mtime."""
+		h = hashlib.sha1(f'v{self.cache_version}:{self.image_size}:{self.draft}\n'.encode())
+
+		st = os.stat(self.image_paths_file)
+		h.update(f'{self.image_paths_file}:{st.st_size}:{st.st_mtime_ns}\n'.encode())
+
+		for rel_path, size, mtime in self.source_stats():
+			h.update(f'{rel_path}:{size}:{mtime}\n'.encode())
+
+		return h.hexdigest()
+
+	def build_cache(self, force=False):
+		"""Write the preprocessed store, unless an up to date one already exists."""
+		images_file, labels_file, fingerprint_file = self.cache_files()
+		fingerprint = self.fingerprint()
+
+		if not force and self.cache_matches(fingerprint):
+			return
+
+		os.makedirs(self.cache_dir, exist_ok=True)
+		size = self.image_size
+
+		# processes building the same cache (e.g. one per DDP rank) take turns,
+		# the ones that wait find it up to date once they hold the lock
+
+		with file_lock(fingerprint_file + '.lock'):
+			if not force and self.cache_matches(fingerprint):
+				return
+
+			# write to per process temporary files and move them into place once complete,
+			# so an interrupted build is never mistaken for a valid cache
+
+			tmp_images_file, tmp_labels_file = (f'{path}.{os.getpid()}.tmp.npy' for path in (images_file, labels_file))
+			images = np.lib.format.open_memmap(tmp_images_file, mode='w+', dtype=np.uint8, shape=(len(self), size, size, 3))
+			labels = np.lib.format.open_memmap(tmp_labels_file, mode='w+', dtype=np.uint8, shape=(len(self), size, size))
+
+			for index in tqdm(range(len(self)), desc='preprocessing segmentation data'):
+				images[index], labels[index] = self.decode_item(index)
+
+			images.flush()
+			labels.flush()
+			del images, labels
+
+			if os.path.exists(fingerprint_file):
+				os.remove(fingerprint_file)
+
+			os.replace(tmp_images_file, images_file)
+			os.replace(tmp_labels_file, labels_file)
+
+			with open(fingerprint_file, 'w') as f:
+				f.write(fingerprint)
+
+		self.images = None
+		self.labels = None
+
+	def cache_matches(self, fingerprint):
+		fingerprint_file = self.cache_files()[-1]
+
+		if not os.path.exists(fingerprint_file):
+			return False
+
+		with open(fingerprint_file) as f:
+			return f.read() == fingerprint
+
+	def open_cache(self):
+		if self.images is not None:
+			return
+
+		images_file, labels_file, _ = self.cache_files()
+		self.images = np.load(images_file, mmap_mode='r')
+		self.labels = np.load(labels_file, mmap_mode='r')
@@ -1,3 +1,7 @@
+import os
+import json
+import time
+from pathlib import Path
 from functools import wraps
 from packaging import version
 from collections import namedtuple
@@ -8,10 +12,27 @@ import torch.nn.functional as F
 
 from einops import rearrange
 
+try:
+    from torch.nn.attention import sdpa_kernel, SDPBackend
+except ImportError:
+    sdpa_kernel = SDPBackend = None
+
 # constants
 
 AttentionConfig = namedtuple('AttentionConfig', ['enable_flash', 'enable_math', 'enable_mem_efficient'])
 
+# scaled dot product attention restricted to one kernel, for the autotuner
+
+SDPA_BACKEND_CONFIGS = dict(
+    sdpa_flash = AttentionConfig(True, False, False),
+    sdpa_math = AttentionConfig(False, True, False),
+    sdpa_mem_efficient = AttentionConfig(False, False, True)
+)
+
+# the budget of the chunked backend when the Attend has none
+
+DEFAULT_CHUNK_MEMORY_BUDGET = 64 * 2 ** 20
+
 # helpers
 
 def exists(val):
@@ -33,6 +54,124 @@ def once(fn):
 
 print_once = once(print)
 
+def sdpa_context(config: AttentionConfig):
+    # torch.backends.cuda.sdp_kernel is deprecated from pytorch 2.3 on, in favor of torch.nn.attention.sdpa_kernel
+
+    if not exists(sdpa_kernel):
+        return torch.backends.cuda.sdp_kernel(**config._asdict())
+
+    backends = [backend for enabled, backend in zip(config, (SDPBackend.FLASH_ATTENTION, SDPBackend.MATH, SDPBackend.EFFICIENT_ATTENTION)) if enabled]
+    return sdpa_kernel(backends)
+
+# autotuner
+
+class AttentionAutotuner:
+    """
+    picks the fastest attention backend per (q shape, k shape, v shape, dtype, device, training) key
+
+    on first use of a key every backend the Attend offers is run and timed with dropout off (forward only)
+    backends that fail or deviate from the einsum reference beyond the tolerance of the dtype are discarded
+    winners are kept in memory, and in a json file at `cache_path` if given, which is ignored when written by another pytorch version
+    """
+
+    def __init__(self, cache_path = None, repeats = 5):
+        self.cache_path = Path(cache_path) if exists(cache_path) else None
+        self.repeats = repeats
+        self.winners = self.load()
+        self.timings = dict()
+
+    def load(self):
+        if not exists(self.cache_path):
+            return dict()
+
+        try:
+            data = json.loads(self.cache_path.read_text())
+        except (OSError, ValueError):
+            return dict()
+
+        return data['winners'] if data.get('torch') == torch.__version__ else dict()
+
+    def save(self):
+        if not exists(self.cache_path):
+            return
+
+        tmp_path = self.cache_path.with_name(self.cache_path.name + '.tmp')
+
+        try:
+            self.cache_path.parent.mkdir(parents = True, exist_ok = True)
+            tmp_path.write_text(json.dumps(dict(torch = torch.__version__, winners = self.winners), indent = 2))
+            os.replace(tmp_path, self.cache_path)
+        except OSError as e:
+            print(f'could not write attention autotuning cache to {self.cache_path}: {e}')
+
+    def key(self, q, k, v, mem_kv, training):
+        device = torch.cuda.get_device_name(q.device) if q.is_cuda else q.device.type
+        num_mem_kv = mem_kv[0].shape[-2] if exists(mem_kv) else 0
+        return f'{tuple(q.shape)}|{tuple(k.shape)}|{tuple(v.shape)}|{num_mem_kv}|{q.dtype}|{device}|{"train" if training else "eval"}'
+
+    def backend(self, attend, q, k, v, mem_kv = None):
+        key = self.key(q, k, v, mem_kv, attend.training)
+
+        if key not in self.winners:
+            self.winners[key] = self.tune(attend, key, q, k, v, mem_kv)
+            self.save()
+
+        return self.winners[key]
+
+    def time(self, fn, device):
+        sync = torch.cuda.synchronize if device.type == 'cuda' else lambda: None
+
+        fn()
+        sync()
+
+        start = time.perf_counter()
+
+        for _ in range(self.repeats):
+            fn()
+
+        sync()
+        return (time.perf_counter() - start) / self.repeats
+
+    @torch.no_grad()
+    def tune(self, attend, key, q, k, v, mem_kv = None):
+        was_training = attend.training
+        attend.eval()
+
+        atol, rtol = (1e-2, 1e-2) if q.dtype in (torch.float16, torch.bfloat16) else (1e-4, 1e-3)
+        reference = attend.run_backend('einsum', q, k, v, mem_kv)
+
+        timings = dict()
+
+        for name in attend.backends(q):
+            run = lambda: attend.run_backend(name, q, k, v, mem_kv)
+
+            try:
+                out = run()
+            except RuntimeError:
+                continue
+
+            if not torch.allclose(out, reference, atol = atol, rtol = rtol):
+                continue
+
+            timings[name] = self.time(run, q.device)
+
+        attend.train(was_training)
+
+        self.timings[key] = timings
+        return min(timings, key = timings.get)
+
+autotuners = dict()
+
+def get_autotuner(cache_path = None):
+    # one autotuner per cache file, shared by all Attend modules
+
+    cache_path = str(cache_path) if exists(cache_path) else None
+
+    if cache_path not in autotuners:
+        autotuners[cache_path] = AttentionAutotuner(cache_path)
+
+    return autotuners[cache_path]
+
 # main class
 
 class Attend(nn.Module):
@@ -40,13 +179,24 @@ class Attend(nn.Module):
         self,
         dropout = 0.,
         flash = False,
-        scale = None
+        scale = None,
+        memory_budget = None,
+        autotune = False,
+        autotune_cache_path = None
     ):
         super().__init__()
         self.dropout = dropout
         self.scale = scale
         self.attn_dropout = nn.Dropout(dropout)
 
+        # bytes the einsum path may spend on attention matrices, above which it attends in chunks
+
+        self.memory_budget = memory_budget
+
+        # per shape choice of the fastest backend, overriding `flash` and `memory_budget`
+
+        self.autotuner = get_autotuner(autotune_cache_path) if autotune else None
+
         self.flash = flash
         assert not (flash and version.parse(torch.__version__) < version.parse('2.0.0')), 'in order to use flash attention, you must be using pytorch 2.0 or above'
 
@@ -69,22 +219,28 @@ class Attend(nn.Module):
             print_once('Non-A100 GPU detected, using math or mem efficient attention if input tensor is on cuda')
             self.cuda_config = AttentionConfig(False, True, True)
 
-    def flash_attn(self, q, k, v):
-        _, heads, q_len, _, k_len, is_cuda, device = *q.shape, k.shape[-2], q.is_cuda, q.device
+    def flash_attn(self, q, k, v, mem_kv = None, config = None):
+        batch, heads, q_len, _, k_len, is_cuda, device = *q.shape, k.shape[-2], q.is_cuda, q.device
 
         if exists(self.scale):
             default_scale = q.shape[-1]
             q = q * (self.scale / default_scale)
 
+        # the fused kernels need the memory key / values in the keys, expanded over the batch as views, so the concatenation is the only copy
+
+        if exists(mem_kv):
+            mk, mv = map(lambda t: t.expand(batch, -1, -1, -1), mem_kv)
+            k, v = torch.cat((mk, k), dim = -2), torch.cat((mv, v), dim = -2)
+
         q, k, v = map(lambda t: t.contiguous(), (q, k, v))
 
         # Check if there is a compatible device for flash attention
 
-        config = self.cuda_config if is_cuda else self.cpu_config
+        config = default(config, self.cuda_config if is_cuda else self.cpu_config)
 
         # pytorch 2.0 flash attn: q, k, v, mask, dropout, causal, softmax_scale
 
-        with torch.backends.cuda.sdp_kernel(**config._asdict()):
+        with sdpa_context(config):
             out = F.scaled_dot_product_attention(
                 q, k, v,
                 dropout_p = self.dropout if self.training else 0.
@@ -92,22 +248,111 @@ class Attend(nn.Module):
 
         return out
 
-    def forward(self, q, k, v):
+    def chunk_sizes(self, q, k, memory_budget = None):
+        # the similarities, their exponent and the attention weights are alive at the same time
+
+        b, h, q_len, _, k_len = *q.shape, k.shape[-2]
+        budget = default(memory_budget, self.memory_budget) // (b * h * q.element_size() * 3)
+
+        q_chunk = min(max(budget // k_len, 1), q_len)
+        k_chunk = min(max(budget // q_chunk, 1), k_len)
+        return q_chunk, k_chunk
+
+    def chunked_attn(self, q, k, v, scale, q_chunk, k_chunk, mem_kv = None):
+        """
+        attention over chunks of `q_chunk` queries, keeping at most (q_chunk, k_chunk) similarities per batch and head alive
+        key blocks are combined with an online softmax, rescaling the running sum of values by the change of the running row max
+        memory key / values of shape (heads, num mem kv, dim head) are the first block, broadcast over the batch rather than copied into the keys
+        """
+        blocks = list(zip(k.split(k_chunk, dim = -2), v.split(k_chunk, dim = -2)))
+
+        if exists(mem_kv) and mem_kv[0].shape[-2] > 0:
+            blocks.insert(0, mem_kv)
+
+        outs = []
+
+        for q_part in q.split(q_chunk, dim = -2):
+            out = row_max = row_sum = None
+
+            for k_part, v_part in blocks:
+                sim = (q_part @ k_part.transpose(-1, -2)) * scale
+                block_max = sim.amax(dim = -1, keepdim = True)
+
+                if not exists(out):
+                    row_max = block_max
+                    exp_sim = (sim - row_max).exp()
+                    row_sum = exp_sim.sum(dim = -1, keepdim = True)
+                    out = self.attn_dropout(exp_sim) @ v_part
+                    continue
+
+                new_row_max = torch.maximum(row_max, block_max)
+                correction = (row_max - new_row_max).exp()
+                exp_sim = (sim - new_row_max).exp()
+
+                row_sum = row_sum * correction + exp_sim.sum(dim = -1, keepdim = True)
+                out = out * correction + self.attn_dropout(exp_sim) @ v_part
+                row_max = new_row_max
+
+            outs.append(out / row_sum)
+
+        return torch.cat(outs, dim = -2)
+
+    def backends(self, q):
+        # every backend is offered on every device, the autotuner skips those that fail for the given input
+
+        return ['sdpa_flash', 'sdpa_math', 'sdpa_mem_efficient', 'einsum', 'chunked']
+
+    def run_backend(self, name, q, k, v, mem_kv = None):
+        if name in SDPA_BACKEND_CONFIGS:
+            return self.flash_attn(q, k, v, mem_kv, config = SDPA_BACKEND_CONFIGS[name])
+
+        if name == 'einsum':
+            return self.einsum_attn(q, k, v, mem_kv)
+
+        assert name == 'chunked', f'unknown attention backend {name}'
+
+        scale = default(self.scale, q.shape[-1] ** -0.5)
+        q_chunk, k_chunk = self.chunk_sizes(q, k, default(self.memory_budget, DEFAULT_CHUNK_MEMORY_BUDGET))
+        return self.chunked_attn(q, k, v, scale, q_chunk, k_chunk, mem_kv)
+
+    def forward(self, q, k, v, mem_kv = None):
         """
         einstein notation
         b - batch
         h - heads
         n, i, j - sequence length (base sequence length, source, target)
         d - feature dimension
+
+        mem_kv - optional (memory keys, memory values) of shape (h, n, d), attended to by every batch element ahead of k and v
         """
 
         q_len, k_len, device = q.shape[-2], k.shape[-2], q.device
 
+        if exists(self.autotuner):
+            return self.run_backend(self.autotuner.backend(self, q, k, v, mem_kv), q, k, v, mem_kv)
+
         if self.flash:
-            return self.flash_attn(q, k, v)
+            return self.flash_attn(q, k, v, mem_kv)
+
+        # chunked attention when the full similarity matrix would not fit the memory budget
+
+        if exists(self.memory_budget):
+            q_chunk, k_chunk = self.chunk_sizes(q, k)
 
+            if q_chunk < q_len or k_chunk < k_len:
+                scale = default(self.scale, q.shape[-1] ** -0.5)
+                return self.chunked_attn(q, k, v, scale, q_chunk, k_chunk, mem_kv)
+
+        return self.einsum_attn(q, k, v, mem_kv)
+
+    def einsum_attn(self, q, k, v, mem_kv = None):
         scale = default(self.scale, q.shape[-1] ** -0.5)
 
+        # memory key / values are a separate softmax block broadcast over the batch
+
+        if exists(mem_kv):
+            return self.chunked_attn(q, k, v, scale, q.shape[-2], k.shape[-2], mem_kv)
+
         # similarity
 
         sim = einsum(f"b h i d, b h j d -> b h i j", q, k) * scale
@@ -0,0 +1,378 @@
+"""
+data pipeline benchmarks, results are printed (and optionally written) as json
+
+python -m denoising_diffusion_pytorch.benchmark_data label_decode
+python -m denoising_diffusion_pytorch.benchmark_data draft_decode --paths img1.jpg img2.jpg
+python -m denoising_diffusion_pytorch.benchmark_data loader --num-workers 0 2 4 --batch-sizes 16 64 --output loader.json
+"""
+
+import argparse
+import io
+import json
+import os
+import platform
+import resource
+import shutil
+import tempfile
+import time
+from collections import defaultdict
+from itertools import product
+from pathlib import Path
+
+import numpy as np
+import torch
+from torch.utils.data import DataLoader, default_collate
+from PIL import Image
+from torchvision import transforms as T
+
+from denoising_diffusion_pytorch.Segmentation_train_data import SEG_LABELS_LIST, SegmentationtrainData, label_img_to_train_labels, stacked_collate
+from denoising_diffusion_pytorch.draft_decode import draft_image, DRAFT_MAX_ABS_ERROR, DRAFT_MEAN_ABS_ERROR
+
+# reference implementation, the per label mask loop SegmentationtrainData used before the lookup table
+
+def label_img_to_train_labels_loop(label_img):
+    r = np.asarray(label_img)
+    target = np.stack((r, np.zeros_like(r), np.zeros_like(r)), axis = -1).astype(np.int64)
+    target_labels = target[..., 0]
+
+    for label in SEG_LABELS_LIST:
+        mask = np.all(target == label['rgb_values'], axis = 2)
+        target_labels[mask] = label['id']
+
+    return target_labels
+
+def timeit(fn, *args, repeats = 50):
+    fn(*args)
+    start = time.perf_counter()
+    for _ in range(repeats):
+        fn(*args)
+    return (time.perf_counter() - start) / repeats
+
+# benchmarks
+
+def bench_label_decode(image_size = 256, repeats = 50, seed = 0):
+    rng = np.random.default_rng(seed)
+    label_img = rng.integers(0, 256, size = (image_size, image_size), dtype = np.uint8)
+
+    assert np.array_equal(label_img_to_train_labels(label_img), label_img_to_train_labels_loop(label_img))
+
+    loop_time = timeit(label_img_to_train_labels_loop, label_img, repeats = repeats)
+    lut_time = timeit(label_img_to_train_labels, label_img, repeats = repeats)
+
+    return dict(
+        benchmark = 'label_decode',
+        image_size = image_size,
+        loop_ms = loop_time * 1e3,
+        lut_ms = lut_time * 1e3,
+        speedup = loop_time / lut_time
+    )
+
+def synthetic_photo(size, seed = 0):
+    # smooth gradients plus a little noise, compresses and scales roughly like a photo
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[0:size, 0:size] / size
+    channels = [np.sin(2 * np.pi * (x * rng.uniform(1, 4) + y * rng.uniform(1, 4))) for _ in range(3)]
+    img = (np.stack(channels, axis = -1) * 0.5 + 0.5) * 255 + rng.normal(0, 8, (size, size, 3))
+    return Image.fromarray(img.clip(0, 255).astype(np.uint8))
+
+def encoded_fixture(source_size = 1024, format = 'JPEG'):
+    buffer = io.BytesIO()
+    synthetic_photo(source_size).save(buffer, format = format, **(dict(quality = 90) if format == 'JPEG' else dict()))
+    return buffer.getvalue()
+
+def draft_decode_errors(data, image_size):
+    resize = T.Resize((image_size, image_size))
+
+    def decode(draft):
+        img = Image.open(io.BytesIO(data))
+        if draft:
+            img = draft_image(img, (image_size, image_size))
+        return np.asarray(resize(img.convert('RGB')), dtype = np.int16)
+
+    return np.abs(decode(False) - decode(True)).ravel()
+
+def check_draft_decode(image_sizes = (64, 128, 256), source_size = 1024):
+    """ asserts the error bound documented on `draft_image`, for the jpeg (draft) and png (reduce) paths on the synthetic fixtures """
+    checked = []
+
+    for format, image_size in product(('JPEG', 'PNG'), image_sizes):
+        errors = draft_decode_errors(encoded_fixture(source_size, format), image_size)
+        max_error, mean_error = int(errors.max()), float(errors.mean())
+
+        assert max_error <= DRAFT_MAX_ABS_ERROR, f'draft decoding of a {format} at {image_size}px is off by up to {max_error}, above the bound of {DRAFT_MAX_ABS_ERROR}'
+        assert mean_error <= DRAFT_MEAN_ABS_ERROR, f'draft decoding of a {format} at {image_size}px is off by {mean_error:.3f} on average, above the bound of {DRAFT_MEAN_ABS_ERROR}'
+
+        checked.append(dict(format = format, image_size = image_size, max_abs_error = max_error, mean_abs_error = mean_error))
+
+    return checked
+
+def bench_draft_decode(image_size = 256, repeats = 20, source_size = 1024, paths = None):
+    resize = T.Resize((image_size, image_size))
+
+    sources = [open(path, 'rb').read() for path in paths] if paths else [encoded_fixture(source_size)]
+
+    def decode(data, draft):
+        img = Image.open(io.BytesIO(data))
+        if draft:
+            img = draft_image(img, (image_size, image_size))
+        return np.asarray(resize(img.convert('RGB')), dtype = np.int16)
+
+    errors = np.concatenate([draft_decode_errors(data, image_size) for data in sources])
+
+    full_time = timeit(lambda: [decode(data, False) for data in sources], repeats = repeats) / len(sources)
+    draft_time = timeit(lambda: [decode(data, True) for data in sources], repeats = repeats) / len(sources)
+
+    return dict(
+        benchmark = 'draft_decode',
+        image_size = image_size,
+        num_images = len(sources),
+        full_ms = full_time * 1e3,
+        draft_ms = draft_time * 1e3,
+        speedup = full_time / draft_time,
+        mean_abs_error = float(errors.mean()),
+        p99_abs_error = float(np.percentile(errors, 99)),
+        max_abs_error = int(errors.max()),
+        bound_check = check_draft_decode(source_size = source_size)
+    )
+
+# synthetic data, laid out like the ADE style folders SegmentationtrainData reads
+
+def make_synthetic_folder(root, num_images = 256, source_size = 512, num_classes = 100, seed = 0):
+    root = Path(root)
+    index_file = root / 'index.txt'
+
+    # a folder generated with the same settings is reused, one generated with others is regenerated
+
+    config = dict(num_images = num_images, source_size = source_size, num_classes = num_classes, seed = seed)
+    config_file = root / 'synthetic.json'
+
+    if index_file.exists():
+        assert config_file.exists(), f'{root} has an index.txt that was not generated by this benchmark, pass another --data-dir'
+
+        if json.loads(config_file.read_text()) == config:
+            return index_file
+
+        config_file.unlink()
+        index_file.unlink()
+
+        for folder in ('images', 'annotations_instance'):
+            shutil.rmtree(root / folder, ignore_errors = True)
+
+    (root / 'images').mkdir(parents = True, exist_ok = True)
+    (root / 'annotations_instance').mkdir(parents = True, exist_ok = True)
+
+    rng = np.random.default_rng(seed)
+    block = -(-source_size // 8)
+    names = []
+
+    for i in range(num_images):
+        name = f'{i:06d}'
+        synthetic_photo(source_size, seed = seed + i).save(root / 'images' / f'{name}.jpg', quality = 90)
+
+        # blocky label map with the class codes in the red channel
+
+        codes = rng.integers(0, num_classes + 1, size = (8, 8), dtype = np.uint8)
+        codes = np.kron(codes, np.ones((block, block), dtype = np.uint8))[:source_size, :source_size]
+
+        label = np.zeros((source_size, source_size, 3), dtype = np.uint8)
+        label[..., 0] = codes
+        Image.fromarray(label).save(root / 'annotations_instance' / f'{name}.png')
+
+        names.append(f'{name}.jpg')
+
+    index_file.write_text('\n'.join(names))
+    config_file.write_text(json.dumps(config))
+    return index_file
+
+def build_dataset(name, index_file, image_size):
+    if name == 'segmentation':
+        return SegmentationtrainData(str(index_file), batched = True), stacked_collate
+
+    from denoising_diffusion_pytorch.denoising_diffusion_pytorch import Dataset
+    return Dataset(index_file.parent / 'images', image_size, convert_image_to = 'RGB'), default_collate
+
+# per stage timings, measured in process on the same steps the datasets run
+
+class StageTimer:
+    def __init__(self):
+        self.totals = defaultdict(float)
+        self.last = time.perf_counter()
+
+    def __call__(self, stage):
+        now = time.perf_counter()
+        self.totals[stage] += now - self.last
+        self.last = now
+
+def load_image(path, timer, mode = None):
+    with open(path, 'rb') as f:
+        data = f.read()
+    timer('open')
+
+    img = Image.open(io.BytesIO(data))
+    img.load()
+    if mode is not None and img.mode != mode:
+        img = img.convert(mode)
+    timer('decode')
+    return img
+
+def stage_times(name, ds, num_samples, batch_size):
+    timer = StageTimer()
+    samples = []
+
+    for index in range(num_samples):
+        if name == 'segmentation':
+            img = load_image(ds.image_path(index), timer, 'RGB')
+            target = load_image(ds.target_path(index), timer)
+            if target.mode not in ('RGB', 'L'):
+                target = target.convert('RGB')
+            timer('decode')
+
+            img = ds.resize(img)
+            target = ds.target_resize(target.getchannel(0))
+            timer('resize')
+
+            target_labels = torch.from_numpy(ds.label_lut[np.array(target)])
+            timer('label_decode')
+
+            samples.append((ds.to_tensor(img), target_labels))
+            timer('to_tensor')
+        else:
+            img = load_image(ds.paths[index], timer, 'RGB')
+
+            img = ds.cache_transform(img)
+            timer('resize')
+
+            samples.append(ds.cached_transform(img))
+            timer('to_tensor')
+
+    for start in range(0, num_samples, batch_size):
+        default_collate(samples[start:start + batch_size])
+    timer('collate')
+
+    return {f'{stage}_ms': seconds / num_samples * 1e3 for stage, seconds in timer.totals.items()}
+
+# dataloader throughput
+
+def cpu_seconds(who):
+    usage = resource.getrusage(who)
+    return usage.ru_utime + usage.ru_stime
+
+def measure_loader(ds, collate_fn, num_workers, batch_size, pin_memory, num_samples):
+    dl = DataLoader(ds, batch_size = batch_size, sampler = range(num_samples), num_workers = num_workers, pin_memory = pin_memory, collate_fn = collate_fn)
+
+    self_start, children_start = cpu_seconds(resource.RUSAGE_SELF), cpu_seconds(resource.RUSAGE_CHILDREN)
+    start = time.perf_counter()
+
+    samples = 0
+    for batch in dl:
+        samples += len(batch[0]) if isinstance(batch, (tuple, list)) else len(batch)
+
+    elapsed = time.perf_counter() - start
+
+    # workers are joined once the (non persistent) iterator is exhausted, so their cpu time is in RUSAGE_CHILDREN by now
+
+    if num_workers > 0:
+        worker_cpu = cpu_seconds(resource.RUSAGE_CHILDREN) - children_start
+    else:
+        worker_cpu = cpu_seconds(resource.RUSAGE_SELF) - self_start
+
+    return dict(
+        num_workers = num_workers,
+        batch_size = batch_size,
+        pin_memory = pin_memory,
+        samples = samples,
+        seconds = elapsed,
+        samples_per_sec = samples / elapsed,
+        worker_cpu_utilization = worker_cpu / (elapsed * max(num_workers, 1))
+    )
+
+def bench_loader(
+    datasets = ('diffusion', 'segmentation'),
+    num_workers = (0, 2, 4),
+    batch_sizes = (16, 64),
+    pin_memory = (False, True),
+    num_images = 256,
+    num_samples = None,
+    source_size = 512,
+    image_size = 256,
+    data_dir = None,
+    seed = 0
+):
+    num_samples = min(num_samples or num_images, num_images)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        index_file = make_synthetic_folder(data_dir or tmp_dir, num_images = num_images, source_size = source_size, seed = seed)
+
+        results = dict(
+            benchmark = 'loader',
+            config = dict(num_images = num_images, num_samples = num_samples, source_size = source_size, image_size = image_size, seed = seed),
+            environment = dict(python = platform.python_version(), torch = torch.__version__, cpu_count = os.cpu_count(), torch_threads = torch.get_num_threads()),
+            datasets = dict()
+        )
+
+        for name in datasets:
+            ds, collate_fn = build_dataset(name, index_file, image_size)
+
+            results['datasets'][name] = dict(
+                stage_times = stage_times(name, ds, num_samples, max(batch_sizes)),
+                loader = [measure_loader(ds, collate_fn, *config, num_samples) for config in product(num_workers, batch_sizes, pin_memory)]
+            )
+
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description = 'data pipeline benchmarks')
+    subparsers = parser.add_subparsers(dest = 'benchmark', required = True)
+
+    label_decode = subparsers.add_parser('label_decode', help = 'lookup table vs per label loop annotation decoding')
+    label_decode.add_argument('--image-size', type = int, default = 256)
+    label_decode.add_argument('--repeats', type = int, default = 50)
+
+    draft_decode = subparsers.add_parser('draft_decode', help = 'reduced scale vs full jpeg decoding, time and pixel error, asserting the documented error bound on synthetic fixtures')
+    draft_decode.add_argument('--image-size', type = int, default = 256)
+    draft_decode.add_argument('--repeats', type = int, default = 20)
+    draft_decode.add_argument('--paths', nargs = '*', help = 'source images, a synthetic jpeg is used otherwise')
+
+    loader = subparsers.add_parser('loader', help = 'Dataset and SegmentationtrainData throughput on a synthetic folder')
+    loader.add_argument('--datasets', nargs = '+', choices = ('diffusion', 'segmentation'), default = ['diffusion', 'segmentation'])
+    loader.add_argument('--num-workers', nargs = '+', type = int, default = [0, 2, 4])
+    loader.add_argument('--batch-sizes', nargs = '+', type = int, default = [16, 64])
+    loader.add_argument('--pin-memory', nargs = '+', type = int, choices = (0, 1), default = [0, 1])
+    loader.add_argument('--num-images', type = int, default = 256)
+    loader.add_argument('--num-samples', type = int, default = None, help = 'samples per configuration, defaults to all images')
+    loader.add_argument('--source-size', type = int, default = 512)
+    loader.add_argument('--image-size', type = int, default = 256, help = 'diffusion Dataset only, SegmentationtrainData is fixed at 256')
+    loader.add_argument('--data-dir', default = None, help = 'where to generate (or reuse) the synthetic folder, a temporary directory otherwise')
+    loader.add_argument('--seed', type = int, default = 0)
+
+    for subparser in (label_decode, draft_decode, loader):
+        subparser.add_argument('--output', default = None, help = 'also write the json results to this file')
+
+    args = parser.parse_args()
+
+    if args.benchmark == 'label_decode':
+        result = bench_label_decode(image_size = args.image_size, repeats = args.repeats)
+    elif args.benchmark == 'draft_decode':
+        result = bench_draft_decode(image_size = args.image_size, repeats = args.repeats, paths = args.paths)
+    else:
+        result = bench_loader(
+            datasets = args.datasets,
+            num_workers = args.num_workers,
+            batch_sizes = args.batch_sizes,
+            pin_memory = [bool(p) for p in args.pin_memory],
+            num_images = args.num_images,
+            num_samples = args.num_samples,
+            source_size = args.source_size,
+            image_size = args.image_size,
+            data_dir = args.data_dir,
+            seed = args.seed
+        )
+
+    output = json.dumps(result, indent = 2)
+    print(output)
+
+    if args.output is not None:
+        Path(args.output).write_text(output)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,383 @@
+"""
+model inference benchmarks, results are printed (and optionally written) as json
+
+python -m denoising_diffusion_pytorch.benchmark_model attention --resolutions 16 32 64 --memory-budget 67108864 --output attention.json
+python -m denoising_diffusion_pytorch.benchmark_model attention_backends --resolutions 8 16 32
+python -m denoising_diffusion_pytorch.benchmark_model mem_kv --image-size 64 --sampling-timesteps 10
+python -m denoising_diffusion_pytorch.benchmark_model channels_last --models unet resunet --image-size 128
+"""
+
+import argparse
+import json
+import platform
+import resource
+import time
+from pathlib import Path
+from functools import partial
+from types import MethodType
+
+import torch
+import torch.multiprocessing as mp
+from torch.profiler import profile, ProfilerActivity
+
+from einops import rearrange, repeat
+
+from denoising_diffusion_pytorch.attend import AttentionAutotuner
+from denoising_diffusion_pytorch.denoising_diffusion_pytorch import GaussianDiffusion, Unet, Attention, LinearAttention, is_channels_last
+
+# helpers
+
+def exists(val):
+    return val is not None
+
+def timeit(fn, *args, repeats = 10):
+    fn(*args)
+    start = time.perf_counter()
+    for _ in range(repeats):
+        fn(*args)
+    return (time.perf_counter() - start) / repeats
+
+def max_rss_bytes():
+    # ru_maxrss is in kilobytes on linux and bytes on macos
+
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return max_rss if platform.system() == 'Darwin' else max_rss * 1024
+
+def peak_memory(fn, *args, device = 'cpu'):
+    """
+    peak bytes allocated by fn beyond what is alive before it is called
+    on cpu this is the growth of the process high water mark, so every measurement needs a fresh process, see `in_subprocess`
+    """
+    if device == 'cuda':
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+        baseline = torch.cuda.memory_allocated()
+        fn(*args)
+        torch.cuda.synchronize()
+        return torch.cuda.max_memory_allocated() - baseline
+
+    baseline = max_rss_bytes()
+    fn(*args)
+    return max_rss_bytes() - baseline
+
+def subprocess_target(queue, fn, kwargs):
+    queue.put(fn(**kwargs))
+
+def in_subprocess(fn, **kwargs):
+    ctx = mp.get_context('spawn')
+    queue = ctx.Queue()
+    process = ctx.Process(target = subprocess_target, args = (queue, fn, kwargs))
+    process.start()
+    result = queue.get()
+    process.join()
+    return result
+
+# reference implementations, the attention forwards that concatenated batch expanded copies of the memory key / values onto the keys and values
+
+def linear_attention_forward_repeat_cat(self, x):
+    b, c, h, w = x.shape
+
+    x = self.norm(x)
+
+    qkv = self.to_qkv(x).chunk(3, dim = 1)
+    q, k, v = map(lambda t: rearrange(t, 'b (h c) x y -> b h c (x y)', h = self.heads), qkv)
+
+    mk, mv = map(lambda t: repeat(t, 'h c n -> b h c n', b = b), self.mem_kv)
+    k, v = map(partial(torch.cat, dim = -1), ((mk, k), (mv, v)))
+
+    q = q.softmax(dim = -2)
+    k = k.softmax(dim = -1)
+
+    q = q * self.scale
+
+    context = torch.einsum('b h d n, b h e n -> b h d e', k, v)
+
+    out = torch.einsum('b h d e, b h d n -> b h e n', context, q)
+    out = rearrange(out, 'b h c (x y) -> b (h c) x y', h = self.heads, x = h, y = w)
+    return self.to_out(out)
+
+def attention_forward_repeat_cat(self, x):
+    b, c, h, w = x.shape
+
+    x = self.norm(x)
+
+    qkv = self.to_qkv(x).chunk(3, dim = 1)
+    q, k, v = map(lambda t: rearrange(t, 'b (h c) x y -> b h (x y) c', h = self.heads), qkv)
+
+    mk, mv = map(lambda t: repeat(t, 'h n d -> b h n d', b = b), self.mem_kv)
+    k, v = map(partial(torch.cat, dim = -2), ((mk, k), (mv, v)))
+
+    out = self.attend(q, k, v)
+
+    out = rearrange(out, 'b h (x y) d -> b (h d) x y', x = h, y = w)
+    return self.to_out(out)
+
+# benchmarks
+
+@torch.inference_mode()
+def attention_run(resolution, dim, heads, dim_head, batch_size, memory_budget, device, seed = 0):
+    torch.manual_seed(seed)
+
+    attn = Attention(dim, heads = heads, dim_head = dim_head, memory_budget = memory_budget).to(device).eval()
+    x = torch.randn(batch_size, dim, resolution, resolution, device = device)
+
+    peak = peak_memory(attn, x, device = device)
+    seconds = timeit(attn, x)
+
+    chunks = None
+
+    if exists(memory_budget):
+        # the memory key / values are a separate block of chunked attention, the keys Attend sizes its chunks by are the sequence alone
+
+        q = k = torch.empty(batch_size, heads, resolution ** 2, dim_head, device = 'meta')
+        chunks = attn.attend.chunk_sizes(q, k)
+
+    # the same weights without a budget, for the numerical difference
+
+    out = attn(x)
+    attn.attend.memory_budget = None
+    max_abs_diff = (attn(x) - out).abs().amax().item()
+
+    return dict(
+        resolution = resolution,
+        memory_budget = memory_budget,
+        chunks = chunks,
+        peak_bytes = peak,
+        seconds = seconds,
+        max_abs_diff = max_abs_diff
+    )
+
+def bench_attention(resolutions = (16, 32, 64), dim = 256, heads = 4, dim_head = 32, batch_size = 4, memory_budget = 64 * 2 ** 20, device = 'cpu'):
+    """ peak memory and time of full Attention, as in the inner Unet stages, without and with a memory budget for the chunked einsum path """
+    results = []
+
+    for resolution in resolutions:
+        for budget in (None, memory_budget):
+            kwargs = dict(resolution = resolution, dim = dim, heads = heads, dim_head = dim_head, batch_size = batch_size, memory_budget = budget, device = device)
+            results.append(in_subprocess(attention_run, **kwargs) if device == 'cpu' else attention_run(**kwargs))
+
+    return dict(
+        config = dict(dim = dim, heads = heads, dim_head = dim_head, batch_size = batch_size, device = device, torch = torch.__version__, num_threads = torch.get_num_threads()),
+        results = results
+    )
+
+@torch.inference_mode()
+def bench_attention_backends(resolutions = (8, 16, 32), dim = 256, heads = 4, dim_head = 32, batch_size = 4, device = 'cpu'):
+    """ per backend times of full Attention at every resolution, as measured by the autotuner, and the backend it picks """
+    attn = Attention(dim, heads = heads, dim_head = dim_head, autotune = True).to(device).eval()
+    autotuner = attn.attend.autotuner = AttentionAutotuner()
+
+    for resolution in resolutions:
+        attn(torch.randn(batch_size, dim, resolution, resolution, device = device))
+
+    return dict(
+        config = dict(dim = dim, heads = heads, dim_head = dim_head, batch_size = batch_size, device = device, torch = torch.__version__, num_threads = torch.get_num_threads()),
+        results = [dict(key = key, seconds = timings, winner = autotuner.winners[key]) for key, timings in autotuner.timings.items()]
+    )
+
+@torch.inference_mode()
+def mem_kv_run(repeat_cat, image_size, dim, batch_size, sampling_timesteps, device, seed = 0):
+    torch.manual_seed(seed)
+
+    unet = Unet(dim, dim_mults = (1, 2, 4, 8))
+    diffusion = GaussianDiffusion(unet, image_size = image_size, sampling_timesteps = sampling_timesteps).to(device).eval()
+
+    if repeat_cat:
+        for module in unet.modules():
+            if isinstance(module, LinearAttention):
+                module.forward = MethodType(linear_attention_forward_repeat_cat, module)
+            elif isinstance(module, Attention):
+                module.forward = MethodType(attention_forward_repeat_cat, module)
+
+    sample = partial(diffusion.sample, batch_size = batch_size)
+
+    peak = peak_memory(sample, device = device)
+    seconds = timeit(sample, repeats = 1)
+
+    if device == 'cuda':
+        allocations = torch.cuda.memory_stats()['allocation.all.allocated']
+        sample()
+        allocations = torch.cuda.memory_stats()['allocation.all.allocated'] - allocations
+        allocated_bytes = None
+    else:
+        # cpu allocations as profiled ops allocating memory themselves
+
+        with profile(activities = [ProfilerActivity.CPU], profile_memory = True) as prof:
+            sample()
+
+        allocating = [event for event in prof.events() if event.self_cpu_memory_usage > 0]
+        allocations = len(allocating)
+        allocated_bytes = sum(event.self_cpu_memory_usage for event in allocating)
+
+    return dict(
+        mem_kv = 'repeat_cat' if repeat_cat else 'broadcast',
+        allocations = allocations,
+        allocated_bytes = allocated_bytes,
+        peak_bytes = peak,
+        seconds = seconds
+    )
+
+def bench_mem_kv(image_size = 64, dim = 32, batch_size = 8, sampling_timesteps = 10, device = 'cpu'):
+    """ allocations and peak memory of a full Unet ddim sampling loop, with memory key / values broadcast vs repeated and concatenated """
+    results = []
+
+    for repeat_cat in (True, False):
+        kwargs = dict(repeat_cat = repeat_cat, image_size = image_size, dim = dim, batch_size = batch_size, sampling_timesteps = sampling_timesteps, device = device)
+        results.append(in_subprocess(mem_kv_run, **kwargs) if device == 'cpu' else mem_kv_run(**kwargs))
+
+    return dict(
+        config = dict(image_size = image_size, dim = dim, batch_size = batch_size, sampling_timesteps = sampling_timesteps, device = device, torch = torch.__version__),
+        results = results
+    )
+
+def nchw_outputs(model, *args):
+    """ names of the modules whose 4d outputs are not channels last, for a model and inputs in channels last """
+    names = []
+
+    def hook(name, module, inputs, output):
+        if torch.is_tensor(output) and output.ndim == 4 and output.shape[1] > 1 and output.shape[-2:].numel() > 1 and not is_channels_last(output):
+            names.append(name)
+
+    handles = [module.register_forward_hook(partial(hook, name)) for name, module in model.named_modules() if name != '']
+    model(*args)
+
+    for handle in handles:
+        handle.remove()
+
+    return names
+
+def channels_last_models(name, image_size, dim, batch_size):
+    if name == 'unet':
+        model = Unet(dim, dim_mults = (1, 2, 4, 8))
+        return model, (torch.randn(batch_size, 3, image_size, image_size), torch.randint(0, 1000, (batch_size,)))
+
+    # the segmentation ResUNet, whose constructor fetches the imagenet resnet50 weights
+
+    from denoising_diffusion_pytorch.ResNet import ResUNet
+    return ResUNet(), (torch.randn(batch_size, 3, image_size, image_size),)
+
+def bench_channels_last(models = ('unet',), image_size = 128, dim = 64, batch_size = 8, repeats = 10, device = 'cpu', seed = 0):
+    """
+    inference time of each model in NCHW and in channels last, with the models and inputs converted up front
+    nchw_outputs lists the modules that fell back to NCHW in the channels last run, empty when the format is kept throughout
+    """
+    results = []
+
+    for name in models:
+        torch.manual_seed(seed)
+        model, inputs = channels_last_models(name, image_size, dim, batch_size)
+        model = model.to(device).eval()
+        inputs = tuple(t.to(device) for t in inputs)
+
+        with torch.inference_mode():
+            out = model(*inputs)
+            seconds = timeit(model, *inputs, repeats = repeats)
+
+            model = model.to(memory_format = torch.channels_last)
+            inputs = tuple(t.contiguous(memory_format = torch.channels_last) if t.ndim == 4 else t for t in inputs)
+
+            channels_last_out = model(*inputs)
+            channels_last_seconds = timeit(model, *inputs, repeats = repeats)
+            fallbacks = nchw_outputs(model, *inputs)
+
+        results.append(dict(
+            model = name,
+            nchw_seconds = seconds,
+            channels_last_seconds = channels_last_seconds,
+            speedup = seconds / channels_last_seconds,
+            output_channels_last = is_channels_last(channels_last_out),
+            nchw_outputs = fallbacks,
+            max_abs_diff = (channels_last_out - out).abs().amax().item()
+        ))
+
+    return dict(
+        config = dict(image_size = image_size, dim = dim, batch_size = batch_size, device = device, torch = torch.__version__, num_threads = torch.get_num_threads(), mkldnn = torch.backends.mkldnn.is_available()),
+        results = results
+    )
+
+def main():
+    parser = argparse.ArgumentParser(description = 'model inference benchmarks')
+    subparsers = parser.add_subparsers(dest = 'benchmark', required = True)
+
+    attention = subparsers.add_parser('attention', help = 'peak memory and time of full attention with and without the chunked einsum path')
+    attention.add_argument('--resolutions', nargs = '+', type = int, default = [16, 32, 64])
+    attention.add_argument('--dim', type = int, default = 256)
+    attention.add_argument('--heads', type = int, default = 4)
+    attention.add_argument('--dim-head', type = int, default = 32)
+    attention.add_argument('--batch-size', type = int, default = 4)
+    attention.add_argument('--memory-budget', type = int, default = 64 * 2 ** 20, help = 'bytes')
+    attention.add_argument('--device', default = 'cpu')
+
+    attention_backends = subparsers.add_parser('attention_backends', help = 'autotuner timings of every attention backend per resolution')
+    attention_backends.add_argument('--resolutions', nargs = '+', type = int, default = [8, 16, 32])
+    attention_backends.add_argument('--dim', type = int, default = 256)
+    attention_backends.add_argument('--heads', type = int, default = 4)
+    attention_backends.add_argument('--dim-head', type = int, default = 32)
+    attention_backends.add_argument('--batch-size', type = int, default = 4)
+    attention_backends.add_argument('--device', default = 'cpu')
+
+    mem_kv = subparsers.add_parser('mem_kv', help = 'allocations and peak memory of a Unet sampling loop, broadcast vs concatenated memory key / values')
+    mem_kv.add_argument('--image-size', type = int, default = 64)
+    mem_kv.add_argument('--dim', type = int, default = 32)
+    mem_kv.add_argument('--batch-size', type = int, default = 8)
+    mem_kv.add_argument('--sampling-timesteps', type = int, default = 10)
+    mem_kv.add_argument('--device', default = 'cpu')
+
+    channels_last = subparsers.add_parser('channels_last', help = 'inference time of the Unet and ResUNet in NCHW vs channels last, and the modules that do not keep channels last')
+    channels_last.add_argument('--models', nargs = '+', choices = ['unet', 'resunet'], default = ['unet'])
+    channels_last.add_argument('--image-size', type = int, default = 128)
+    channels_last.add_argument('--dim', type = int, default = 64, help = 'Unet dim')
+    channels_last.add_argument('--batch-size', type = int, default = 8)
+    channels_last.add_argument('--repeats', type = int, default = 10)
+    channels_last.add_argument('--device', default = 'cpu')
+
+    for subparser in (attention, attention_backends, mem_kv, channels_last):
+        subparser.add_argument('--output', default = None, help = 'also write the json results to this file')
+
+    args = parser.parse_args()
+
+    if args.benchmark == 'attention':
+        result = bench_attention(
+            resolutions = args.resolutions,
+            dim = args.dim,
+            heads = args.heads,
+            dim_head = args.dim_head,
+            batch_size = args.batch_size,
+            memory_budget = args.memory_budget,
+            device = args.device
+        )
+    elif args.benchmark == 'attention_backends':
+        result = bench_attention_backends(
+            resolutions = args.resolutions,
+            dim = args.dim,
+            heads = args.heads,
+            dim_head = args.dim_head,
+            batch_size = args.batch_size,
+            device = args.device
+        )
+    elif args.benchmark == 'mem_kv':
+        result = bench_mem_kv(
+            image_size = args.image_size,
+            dim = args.dim,
+            batch_size = args.batch_size,
+            sampling_timesteps = args.sampling_timesteps,
+            device = args.device
+        )
+    elif args.benchmark == 'channels_last':
+        result = bench_channels_last(
+            models = args.models,
+            image_size = args.image_size,
+            dim = args.dim,
+            batch_size = args.batch_size,
+            repeats = args.repeats,
+            device = args.device
+        )
+
+    output = json.dumps(result, indent = 2)
+    print(output)
+
+    if args.output is not None:
+        Path(args.output).write_text(output)
+
+if __name__ == '__main__':
+    main()
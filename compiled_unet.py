@@ -0,0 +1,151 @@
+import os
+import json
+import hashlib
+from pathlib import Path
+
+import torch
+from torch.nn import Module
+
+# constants
+
+DEFAULT_CACHE_DIR = Path(os.environ.get('XDG_CACHE_HOME', Path.home() / '.cache')) / 'denoising_diffusion_pytorch' / 'compiled'
+
+# helpers
+
+def exists(val):
+    return val is not None
+
+def default(val, d):
+    if exists(val):
+        return val
+    return d() if callable(d) else d
+
+def module_config(model):
+    """ every module's type and plain (bool, int, float, str, tuple) attributes, which covers the constructor arguments weights alone do not """
+    config = []
+
+    for name, module in model.named_modules():
+        attrs = {k: v for k, v in vars(module).items() if not k.startswith('_') and isinstance(v, (bool, int, float, str, tuple))}
+        config.append((name, type(module).__name__, sorted(attrs.items())))
+
+    return repr(config)
+
+def weights_hash(model):
+    h = hashlib.sha256()
+
+    for name, tensor in model.state_dict().items():
+        tensor = tensor.detach().cpu().contiguous()
+        h.update(f'{name}:{tuple(tensor.shape)}:{tensor.dtype}'.encode())
+        h.update(memoryview(tensor.reshape(-1).view(torch.uint8).numpy()))
+
+    return h.hexdigest()
+
+def example_inputs(model, shape, device, dtype):
+    batch = shape[0]
+    x = torch.randn(shape, device = device, dtype = dtype)
+    time = torch.randint(0, 1000, (batch,), device = device, dtype = torch.long)
+
+    if model.self_condition:
+        return x, time, torch.randn(shape, device = device, dtype = dtype)
+
+    return x, time
+
+# compiled wrapper
+
+class CompiledUnet(Module):
+    """
+    drop-in replacement for a Unet at inference, running a TorchScript graph traced for one (batch, channels, height, width) signature
+    inputs of any other shape, or calls with gradients enabled in training mode, fall back to the eager Unet
+
+    diffusion.model = compile_unet(diffusion.model, batch_size = 16, image_size = 64)
+    """
+
+    def __init__(self, unet, traced, shape):
+        super().__init__()
+        self.unet = unet
+        self.traced = traced
+        self.shape = tuple(shape)
+
+        self.channels = unet.channels
+        self.self_condition = unet.self_condition
+        self.out_dim = unet.out_dim
+        self.random_or_learned_sinusoidal_cond = unet.random_or_learned_sinusoidal_cond
+
+    @property
+    def downsample_factor(self):
+        return self.unet.downsample_factor
+
+    def forward(self, x, time, x_self_cond = None):
+        if tuple(x.shape) != self.shape or time.dtype != torch.long or (self.training and torch.is_grad_enabled()):
+            return self.unet(x, time, x_self_cond)
+
+        if self.self_condition:
+            x_self_cond = default(x_self_cond, lambda: torch.zeros_like(x))
+            return self.traced(x, time, x_self_cond)
+
+        return self.traced(x, time)
+
+def compile_unet(
+    unet,
+    batch_size,
+    image_size,
+    *,
+    device = None,
+    dtype = torch.float32,
+    cache_dir = None,
+    check = True,
+    atol = 1e-4,
+    rtol = 1e-3
+):
+    """
+    traces and freezes `unet` for inputs of (batch_size, channels, *image_size)
+    the frozen graph is cached on disk keyed by the model config, a hash of the weights, the signature and the torch version, so warm starts skip tracing
+    oneDNN inference optimizations are applied after loading, and a freshly compiled graph is checked against eager within (atol, rtol)
+    """
+    if isinstance(image_size, int):
+        image_size = (image_size, image_size)
+
+    device = torch.device(default(device, lambda: next(unet.parameters()).device))
+    unet = unet.eval()
+
+    # a filled time conditioning cache or an attached deep feature cache would be traced into the graph as constants
+
+    if hasattr(unet, 'clear_time_cache'):
+        unet.clear_time_cache()
+
+    if hasattr(unet, 'deep_cache'):
+        unet.deep_cache = None
+
+    shape = (batch_size, unet.channels, *image_size)
+
+    key = json.dumps(dict(
+        shape = shape,
+        dtype = str(dtype),
+        device = device.type,
+        config = module_config(unet),
+        weights = weights_hash(unet),
+        torch = torch.__version__
+    ))
+
+    path = Path(default(cache_dir, DEFAULT_CACHE_DIR)) / f'unet-{hashlib.sha256(key.encode()).hexdigest()[:32]}.pt'
+
+    if path.exists():
+        traced = torch.jit.load(str(path), map_location = device)
+    else:
+        inputs = example_inputs(unet, shape, device, dtype)
+
+        with torch.no_grad():
+            traced = torch.jit.freeze(torch.jit.trace(unet, inputs, check_trace = False))
+
+            if check:
+                expected, actual = unet(*inputs), traced(*inputs)
+                assert torch.allclose(expected, actual, atol = atol, rtol = rtol), f'compiled unet deviates from eager by up to {(expected - actual).abs().max().item()}'
+
+        path.parent.mkdir(parents = True, exist_ok = True)
+        tmp_path = path.with_name(path.name + '.tmp')
+        torch.jit.save(traced, str(tmp_path))
+        os.replace(tmp_path, path)
+
+    traced = torch.jit.optimize_for_inference(traced)
+
+    return CompiledUnet(unet, traced, shape)
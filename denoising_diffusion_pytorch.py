@@ -1,15 +1,19 @@
 import math
 import copy
+import threading
 from pathlib import Path
 from random import random
-from functools import partial
+from functools import partial, wraps
+from contextlib import contextmanager
 from collections import namedtuple
 from multiprocessing import cpu_count
 
 import torch
 from torch import nn, einsum
 import torch.nn.functional as F
+import torch.multiprocessing as mp
 from torch.nn import Module, ModuleList
+from torch.utils.checkpoint import checkpoint
 from torch.amp import autocast
 from torch.utils.data import Dataset, DataLoader
 
@@ -18,7 +22,6 @@ from torch.optim import Adam
 from torchvision import transforms as T, utils
 
 from einops import rearrange, reduce, repeat
-from einops.layers.torch import Rearrange
 
 from scipy.optimize import linear_sum_assignment
 
@@ -29,6 +32,8 @@ from ema_pytorch import EMA
 from accelerate import Accelerator
 
 from denoising_diffusion_pytorch.attend import Attend
+from denoising_diffusion_pytorch.file_manifest import FileManifest
+from denoising_diffusion_pytorch.draft_decode import draft_image
 
 from denoising_diffusion_pytorch.version import __version__
 
@@ -36,6 +41,27 @@ from denoising_diffusion_pytorch.version import __version__
 
 ModelPrediction =  namedtuple('ModelPrediction', ['pred_noise', 'pred_x_start'])
 
+# per step sampling coefficients, as python floats
+# x_start = start_from_x * x + start_from_out * model_output, clamped to [-1, 1]
+# x_next = next_from_start * x_start + next_from_x * x + noise_scale * noise
+
+SamplingStep = namedtuple('SamplingStep', ['time', 'start_from_x', 'start_from_out', 'next_from_start', 'next_from_x', 'noise_scale'])
+
+# multistep dpm-solver++ step, x_next = x_coef * x + sum(start_coefs[i] * x_start predicted i steps ago)
+# the last step (time 0) has no coefficients and returns its x_start
+
+DPMSolverStep = namedtuple('DPMSolverStep', ['time', 'x_coef', 'start_coefs'])
+
+# time conditioning of a set of timesteps precomputed by the unet, see Unet.cache_time_conditioning
+# versions identify the weights it was computed from, index maps a timestep to its row in the per block projections
+
+TimeCache = namedtuple('TimeCache', ['key', 'versions', 'index', 'projections'])
+CachedTime = namedtuple('CachedTime', ['index', 'projections'])
+
+# the time cache each unet may use in the current thread, see Unet.swap_time_cache
+
+active_time_caches = threading.local()
+
 # helpers functions
 
 def exists(x):
@@ -54,6 +80,26 @@ def cast_tuple(t, length = 1):
 def divisible_by(numer, denom):
     return (numer % denom) == 0
 
+def slide_window(t, n, fill):
+    # drops the first n entries of a window buffer and fills the last n, in place so the buffer keeps its memory layout
+    t[:-n] = t[n:].clone()
+    t[-n:] = fill
+
+def is_channels_last(t):
+    return t.ndim == 4 and not t.is_contiguous() and t.is_contiguous(memory_format = torch.channels_last)
+
+def to_memory_format(t, memory_format):
+    # a batch of images (b, c, h, w), or a stack of them (..., b, c, h, w), laid out channels last per image
+    if memory_format != torch.channels_last or t.ndim < 4:
+        return t
+    return t.movedim(-3, -1).contiguous().movedim(-1, -3)
+
+def heads_to_image(t, h, w, channels_last = False):
+    # (b, heads, h * w, d) -> (b, heads * d, h, w), written out directly in the memory format of the input image
+    if not channels_last:
+        return rearrange(t, 'b heads (x y) d -> b (heads d) x y', x = h, y = w)
+    return rearrange(t, 'b heads (x y) d -> b x y (heads d)', x = h, y = w).contiguous().permute(0, 3, 1, 2)
+
 def identity(t, *args, **kwargs):
     return t
 
@@ -95,8 +141,9 @@ def Upsample(dim, dim_out = None):
     )
 
 def Downsample(dim, dim_out = None):
+    # pixel unshuffle is 'b c (h p1) (w p2) -> b (c p1 p2) h w', with a native channels last kernel
     return nn.Sequential(
-        Rearrange('b c (h p1) (w p2) -> b (c p1 p2) h w', p1 = 2, p2 = 2),
+        nn.PixelUnshuffle(2),
         nn.Conv2d(dim * 4, default(dim_out, dim), 1)
     )
 
@@ -107,7 +154,9 @@ class RMSNorm(Module):
         self.g = nn.Parameter(torch.ones(1, dim, 1, 1))
 
     def forward(self, x):
-        return F.normalize(x, dim = 1) * self.g * self.scale
+        # F.normalize over channels, with the norm broadcast rather than expanded, so channels last inputs stay channels last
+        norm = torch.linalg.vector_norm(x, dim = 1, keepdim = True).clamp(min = 1e-12)
+        return x / norm * self.g * self.scale
 
 # sinusoidal positional embeds
 
@@ -176,11 +225,11 @@ class ResnetBlock(Module):
         self.block2 = Block(dim_out, dim_out)
         self.res_conv = nn.Conv2d(dim, dim_out, 1) if dim != dim_out else nn.Identity()
 
-    def forward(self, x, time_emb = None):
+    def forward(self, x, time_emb = None, cached_time = None):
 
         scale_shift = None
-        if exists(self.mlp) and exists(time_emb):
-            time_emb = self.mlp(time_emb)
+        if exists(self.mlp) and (exists(time_emb) or exists(cached_time)):
+            time_emb = cached_time.projections[self][cached_time.index] if exists(cached_time) else self.mlp(time_emb)
             time_emb = rearrange(time_emb, 'b c -> b c 1 1')
             scale_shift = time_emb.chunk(2, dim = 1)
 
@@ -221,18 +270,38 @@ class LinearAttention(Module):
         qkv = self.to_qkv(x).chunk(3, dim = 1)
         q, k, v = map(lambda t: rearrange(t, 'b (h c) x y -> b h c (x y)', h = self.heads), qkv)
 
-        mk, mv = map(lambda t: repeat(t, 'h c n -> b h c n', b = b), self.mem_kv)
-        k, v = map(partial(torch.cat, dim = -1), ((mk, k), (mv, v)))
-
         q = q.softmax(dim = -2)
-        k = k.softmax(dim = -1)
-
         q = q * self.scale
 
+        # the key softmax runs over the memory and the sequence positions together, with the memory key / values broadcast over the batch instead of concatenated
+
+        # exp(mk - k_max) = exp(mk - mk_max) * exp(mk_max - k_max), so the memory terms are computed once per head and only rescaled per batch element
+
+        mk, mv = self.mem_kv
+        has_mem = mk.shape[-1] > 0
+
+        k_max = k.amax(dim = -1, keepdim = True)
+
+        if has_mem:
+            mk_max = mk.amax(dim = -1, keepdim = True)
+            k_max = torch.maximum(k_max, mk_max)
+
+        k = (k - k_max).exp()
+
+        k_sum = k.sum(dim = -1, keepdim = True)
         context = torch.einsum('b h d n, b h e n -> b h d e', k, v)
 
+        if has_mem:
+            mk = (mk - mk_max).exp()
+            mem_scale = (mk_max - k_max).exp()
+
+            k_sum = k_sum + mem_scale * mk.sum(dim = -1, keepdim = True)
+            context = context + mem_scale * torch.einsum('h d m, h e m -> h d e', mk, mv)
+
+        context = context / k_sum
+
         out = torch.einsum('b h d e, b h d n -> b h e n', context, q)
-        out = rearrange(out, 'b h c (x y) -> b (h c) x y', h = self.heads, x = h, y = w)
+        out = heads_to_image(out.transpose(-1, -2), h, w, channels_last = is_channels_last(x))
         return self.to_out(out)
 
 class Attention(Module):
@@ -242,14 +311,17 @@ class Attention(Module):
         heads = 4,
         dim_head = 32,
         num_mem_kv = 4,
-        flash = False
+        flash = False,
+        memory_budget = None,
+        autotune = False,
+        autotune_cache_path = None
     ):
         super().__init__()
         self.heads = heads
         hidden_dim = dim_head * heads
 
         self.norm = RMSNorm(dim)
-        self.attend = Attend(flash = flash)
+        self.attend = Attend(flash = flash, memory_budget = memory_budget, autotune = autotune, autotune_cache_path = autotune_cache_path)
 
         self.mem_kv = nn.Parameter(torch.randn(2, heads, num_mem_kv, dim_head))
         self.to_qkv = nn.Conv2d(dim, hidden_dim * 3, 1, bias = False)
@@ -263,16 +335,66 @@ class Attention(Module):
         qkv = self.to_qkv(x).chunk(3, dim = 1)
         q, k, v = map(lambda t: rearrange(t, 'b (h c) x y -> b h (x y) c', h = self.heads), qkv)
 
-        mk, mv = map(lambda t: repeat(t, 'h n d -> b h n d', b = b), self.mem_kv)
-        k, v = map(partial(torch.cat, dim = -2), ((mk, k), (mv, v)))
-
-        out = self.attend(q, k, v)
+        out = self.attend(q, k, v, mem_kv = self.mem_kv.unbind(dim = 0))
 
-        out = rearrange(out, 'b h (x y) d -> b (h d) x y', x = h, y = w)
+        out = heads_to_image(out, h, w, channels_last = is_channels_last(x))
         return self.to_out(out)
 
 # model
 
+class DeepFeatureCache:
+    """
+    cross step reuse of the deep unet features during sampling (https://arxiv.org/abs/2312.00858)
+
+    on a refresh step the unet runs fully and keeps the features entering its outer `depth` up stages
+    on the steps in between only the outer `depth` down and up stages run at full resolution, on top of the kept features
+    refreshes every `interval` steps, or whenever `policy(step)` is true if given, and always on the first step or a change of input shape
+    """
+
+    def __init__(self, interval = 3, depth = 1, policy = None):
+        assert interval >= 1 and depth >= 1
+        self.interval = interval
+        self.depth = depth
+        self.policy = policy
+        self.reset()
+
+    def reset(self):
+        self.step = 0
+        self.features = None
+        self.shape = None
+        self.full_steps = 0
+        self.shallow_steps = 0
+
+    def should_refresh(self, x):
+        if not exists(self.features) or x.shape != self.shape:
+            return True
+
+        if exists(self.policy):
+            return self.policy(self.step)
+
+        return divisible_by(self.step, self.interval)
+
+    def record(self, x, refreshed):
+        self.step += 1
+        self.shape = x.shape
+
+        if refreshed:
+            self.full_steps += 1
+        else:
+            self.shallow_steps += 1
+
+    @property
+    def stats(self):
+        return dict(
+            policy = 'custom' if exists(self.policy) else f'every {self.interval} steps',
+            depth = self.depth,
+            full_steps = self.full_steps,
+            shallow_steps = self.shallow_steps
+        )
+
+def clear_time_cache_hook(module, incompatible_keys = None):
+    module.clear_time_cache()
+
 class Unet(Module):
     def __init__(
         self,
@@ -291,7 +413,10 @@ class Unet(Module):
         attn_dim_head = 32,
         attn_heads = 4,
         full_attn = None,    # defaults to full attention only for inner most layer
-        flash_attn = False
+        flash_attn = False,
+        attn_memory_budget = None, # bytes, above which full attention without flash runs in query / key chunks
+        attn_autotune = False,     # time the attention backends per input shape and run the fastest, see AttentionAutotuner
+        attn_autotune_cache_path = None
     ):
         super().__init__()
 
@@ -341,7 +466,7 @@ class Unet(Module):
 
         # prepare blocks
 
-        FullAttention = partial(Attention, flash = flash_attn)
+        FullAttention = partial(Attention, flash = flash_attn, memory_budget = attn_memory_budget, autotune = attn_autotune, autotune_cache_path = attn_autotune_cache_path)
         resnet_block = partial(ResnetBlock, time_emb_dim = time_dim, dropout = dropout)
 
         # layers
@@ -385,10 +510,153 @@ class Unet(Module):
         self.final_res_block = resnet_block(init_dim * 2, init_dim)
         self.final_conv = nn.Conv2d(init_dim, self.out_dim, 1)
 
+        # time conditioning cache for sampling
+
+        self.time_cache = None
+        self.register_load_state_dict_post_hook(clear_time_cache_hook)
+
+        # deep feature reuse across sampling steps, set by GaussianDiffusion while sampling with a DeepFeatureCache
+
+        self.deep_cache = None
+
+        # stages whose activations are recomputed in the backward pass, see `set_checkpointing`
+
+        self.checkpoint_stages = set()
+
     @property
     def downsample_factor(self):
         return 2 ** (len(self.downs) - 1)
 
+    @property
+    def time_conditioned_blocks(self):
+        return [module for module in self.modules() if isinstance(module, ResnetBlock) and exists(module.mlp)]
+
+    def train(self, mode = True):
+        # the cached time conditioning is stale as soon as the weights are trained
+        if mode:
+            self.clear_time_cache()
+
+        return super().train(mode)
+
+    def clear_time_cache(self):
+        self.time_cache = None
+
+    @property
+    def time_cache_versions(self):
+        # in place updates of the weights (optimizer steps, ema updates, `copy_`) bump their version, replacing them changes their storage
+
+        params = [*self.time_mlp.parameters(), *(param for block in self.time_conditioned_blocks for param in block.mlp.parameters())]
+        return tuple((param.data_ptr(), param._version) for param in params)
+
+    @torch.no_grad()
+    def cache_time_conditioning(self, times):
+        """
+        precomputes the time embedding, folded into every resnet block's (scale, shift) projection, for the given integer timesteps
+        returns the TimeCache, reused as long as the timesteps, device and time conditioning weights are unchanged
+
+        forward only looks it up while it is active in the calling thread, see `swap_time_cache`, and gradients are off
+        every timestep passed to forward must then be among the cached ones, others fail the lookup
+        """
+        device = next(self.parameters()).device
+
+        # the key and versions are built on the host, so reusing the cache does not synchronize with the device
+
+        times = sorted(set(int(time) for time in times))
+        key = (tuple(times), device)
+        versions = self.time_cache_versions
+
+        cache = self.time_cache
+
+        if exists(cache) and cache.key == key and cache.versions == versions:
+            return cache
+
+        times = torch.tensor(times, device = device, dtype = torch.long)
+        t = self.time_mlp(times)
+
+        projections = {block: block.mlp(t) for block in self.time_conditioned_blocks}
+
+        # timestep -> row of the projections, timesteps that are not cached point past the last row
+
+        index = torch.full((key[0][-1] + 1,), len(times), device = device, dtype = torch.long)
+        index[times] = torch.arange(len(times), device = device)
+
+        self.time_cache = TimeCache(key, versions, index, projections)
+        return self.time_cache
+
+    def swap_time_cache(self, cache):
+        """
+        makes the given TimeCache (or None) the one forward uses in the calling thread, returns the previously active one
+        """
+        active = active_time_caches.__dict__.setdefault('caches', dict())
+        previous = active.pop(id(self), None)
+
+        if exists(cache):
+            active[id(self)] = cache
+
+        return previous
+
+    def cached_time(self, time):
+        cache = getattr(active_time_caches, 'caches', dict()).get(id(self))
+
+        if not exists(cache) or torch.is_grad_enabled() or time.dtype != torch.long:
+            return None
+
+        return CachedTime(cache.index[time], cache.projections)
+
+    # activation checkpointing, per stage
+
+    @property
+    def stage_names(self):
+        return [*(f'downs.{ind}' for ind in range(len(self.downs))), 'mid', *(f'ups.{ind}' for ind in range(len(self.ups)))]
+
+    def set_checkpointing(self, stages = True):
+        """
+        recompute the activations of the given stages in the backward pass instead of keeping them
+        stages - True for all, False for none, or names among 'downs', 'ups' (all of either), 'downs.{i}', 'mid', 'ups.{i}'
+        """
+        if isinstance(stages, bool):
+            stages = self.stage_names if stages else []
+
+        stages = set(cast_tuple(stages) if isinstance(stages, str) else stages)
+        matches = lambda name, stage: name == stage or name.startswith(f'{stage}.')
+
+        unknown = [stage for stage in stages if not any(matches(name, stage) for name in self.stage_names)]
+        assert len(unknown) == 0, f'unknown unet stages {unknown}, must be among {self.stage_names}'
+
+        self.checkpoint_stages = {name for name in self.stage_names if any(matches(name, stage) for stage in stages)}
+
+    def run_stage(self, name, fn, *args):
+        if name in self.checkpoint_stages and torch.is_grad_enabled():
+            return checkpoint(fn, *args, use_reentrant = False)
+
+        return fn(*args)
+
+    def down_stage(self, ind, x, t, cached_time):
+        block1, block2, attn, _ = self.downs[ind]
+
+        h1 = block1(x, t, cached_time)
+
+        x = block2(h1, t, cached_time)
+        x = attn(x) + x
+        return h1, x
+
+    def mid_stage(self, x, t, cached_time):
+        x = self.mid_block1(x, t, cached_time)
+        x = self.mid_attn(x) + x
+        return self.mid_block2(x, t, cached_time)
+
+    def up_stage(self, ind, x, skip1, skip2, t, cached_time):
+        block1, block2, attn, upsample = self.ups[ind]
+
+        x = torch.cat((x, skip1), dim = 1)
+        x = block1(x, t, cached_time)
+
+        x = torch.cat((x, skip2), dim = 1)
+        x = block2(x, t, cached_time)
+        x = attn(x) + x
+
+        return upsample(x)
+
     def forward(self, x, time, x_self_cond = None):
         assert all([divisible_by(d, self.downsample_factor) for d in x.shape[-2:]]), f'your input dimensions {x.shape[-2:]} need to be divisible by {self.downsample_factor}, given the unet'
 
@@ -399,37 +667,52 @@ class Unet(Module):
         x = self.init_conv(x)
         r = x.clone()
 
-        t = self.time_mlp(time)
+        cached_time = self.cached_time(time)
+        t = self.time_mlp(time) if not exists(cached_time) else None
+
+        # with a deep feature cache, only the outer `depth` stages run on steps between refreshes
+
+        cache = self.deep_cache
+        reuse = exists(cache) and not cache.should_refresh(x)
+        depth = cache.depth if exists(cache) else 0
+
+        assert depth <= len(self.downs), f'deep feature cache depth can be at most {len(self.downs)}'
 
         h = []
 
-        for block1, block2, attn, downsample in self.downs:
-            x = block1(x, t)
-            h.append(x)
+        for ind, (*_, downsample) in enumerate(self.downs):
+            h1, x = self.run_stage(f'downs.{ind}', partial(self.down_stage, ind), x, t, cached_time)
+            h.extend((h1, x))
 
-            x = block2(x, t)
-            x = attn(x) + x
-            h.append(x)
+            if reuse and ind == depth - 1:
+                break
 
             x = downsample(x)
 
-        x = self.mid_block1(x, t)
-        x = self.mid_attn(x) + x
-        x = self.mid_block2(x, t)
+        if not reuse:
+            x = self.run_stage('mid', self.mid_stage, x, t, cached_time)
 
-        for block1, block2, attn, upsample in self.ups:
-            x = torch.cat((x, h.pop()), dim = 1)
-            x = block1(x, t)
+        cached_stage = len(self.ups) - depth
 
-            x = torch.cat((x, h.pop()), dim = 1)
-            x = block2(x, t)
-            x = attn(x) + x
+        for ind in range(len(self.ups)):
+            if reuse and ind < cached_stage:
+                continue
+
+            if exists(cache) and ind == cached_stage:
+                if reuse:
+                    x = cache.features
+                else:
+                    cache.features = x
 
-            x = upsample(x)
+            x = self.run_stage(f'ups.{ind}', partial(self.up_stage, ind), x, h.pop(), h.pop(), t, cached_time)
 
         x = torch.cat((x, r), dim = 1)
 
-        x = self.final_res_block(x, t)
+        x = self.final_res_block(x, t, cached_time)
+
+        if exists(cache):
+            cache.record(r, refreshed = not reuse)
+
         return self.final_conv(x)
 
 # gaussian diffusion trainer class
@@ -439,6 +722,9 @@ def extract(a, t, x_shape):
     out = a.gather(-1, t)
     return out.reshape(b, *((1,) * (len(x_shape) - 1)))
 
+def clear_sampling_tables(module, incompatible_keys):
+    module.sampling_tables.clear()
+
 def linear_beta_schedule(timesteps):
     """
     linear schedule, proposed in original ddpm paper
@@ -475,6 +761,30 @@ def sigmoid_beta_schedule(timesteps, start = -3, end = 3, tau = 1, clamp_min = 1
     betas = 1 - (alphas_cumprod[1:] / alphas_cumprod[:-1])
     return torch.clip(betas, 0, 0.999)
 
+def scopes_time_cache(fn):
+    # the time conditioning a sampling loop caches is only visible to the unet while the loop itself runs, not to the caller between steps
+    # it is only valid for the loop's own timesteps, so it is dropped once the loop ends
+    @wraps(fn)
+    def inner(self, *args, **kwargs):
+        steps, cache = fn(self, *args, **kwargs), None
+
+        try:
+            while True:
+                outer = self.swap_time_cache(cache)
+
+                try:
+                    step = next(steps)
+                except StopIteration:
+                    return
+                finally:
+                    cache = self.swap_time_cache(outer)
+
+                yield step
+        finally:
+            steps.close()
+            self.clear_time_cache()
+    return inner
+
 class GaussianDiffusion(Module):
     def __init__(
         self,
@@ -491,7 +801,8 @@ class GaussianDiffusion(Module):
         offset_noise_strength = 0.,  # https://www.crosslabs.org/blog/diffusion-with-offset-noise
         min_snr_loss_weight = False, # https://arxiv.org/abs/2303.09556
         min_snr_gamma = 5,
-        immiscible = False
+        immiscible = False,
+        channels_last = False
     ):
         super().__init__()
         assert not (type(self) == GaussianDiffusion and model.channels != model.out_dim)
@@ -598,10 +909,234 @@ class GaussianDiffusion(Module):
         self.normalize = normalize_to_neg_one_to_one if auto_normalize else identity
         self.unnormalize = unnormalize_to_zero_to_one if auto_normalize else identity
 
+        # per step sampling coefficients, computed once per (sampler, sampling timesteps, eta) and dropped whenever a state dict is loaded
+
+        self.sampling_tables = dict()
+        self.register_load_state_dict_post_hook(clear_sampling_tables)
+
+        # stats of the last sampling run, if any were collected
+
+        self.sampling_stats = dict()
+
+        # memory format of the unet weights and of every image tensor while training and sampling
+
+        self.set_channels_last(channels_last)
+
     @property
     def device(self):
         return self.betas.device
 
+    @property
+    def memory_format(self):
+        return torch.channels_last if self.channels_last else torch.contiguous_format
+
+    def set_channels_last(self, channels_last = True):
+        """
+        channels last (nhwc) mode, for the nhwc conv kernels of oneDNN on cpu and cudnn on gpu
+        converts the unet weights, and the sampling loops start from channels last noise, which every layer of the Unet keeps
+        training inputs are converted by the Trainer, or pass channels last images to forward
+        """
+        self.channels_last = channels_last
+        self.model.to(memory_format = self.memory_format)
+        return self
+
+    def set_sampling_timesteps(self, sampling_timesteps, ddim_sampling_eta = None):
+        assert sampling_timesteps <= self.num_timesteps
+
+        self.sampling_timesteps = sampling_timesteps
+        self.is_ddim_sampling = sampling_timesteps < self.num_timesteps
+        self.ddim_sampling_eta = default(ddim_sampling_eta, self.ddim_sampling_eta)
+
+    def ddim_times(self, sampling_timesteps):
+        # [T-1, ..., 0, -1] for sampling_timesteps == T, the timesteps -1 + floor(i * T / sampling_timesteps) in decreasing order
+        # in integer arithmetic, so the times of n steps are exactly every other time of 2n steps, which progressive distillation relies on
+
+        return [(i * self.num_timesteps) // sampling_timesteps - 1 for i in reversed(range(sampling_timesteps + 1))]
+
+    @property
+    def can_use_sampling_tables(self):
+        # subclasses that change how the model output is turned into x_start or the posterior use the generic path
+
+        klass = type(self)
+        return klass.model_predictions is GaussianDiffusion.model_predictions and klass.p_mean_variance is GaussianDiffusion.p_mean_variance
+
+    def sampling_table(self, sampling_timesteps = None, eta = 0., ancestral = False):
+        """
+        list of SamplingStep for the ancestral sampler (all timesteps) or ddim with the given number of steps and eta
+        """
+        sampling_timesteps = default(sampling_timesteps, self.num_timesteps)
+        key = ('ancestral',) if ancestral else ('ddim', sampling_timesteps, eta)
+
+        if key in self.sampling_tables:
+            return self.sampling_tables[key]
+
+        # the noise schedule buffers of this module only, not those of the wrapped model
+
+        buffers = {name: buffer.double().tolist() for name, buffer in self.named_buffers(recurse = False)}
+        get = lambda name, time: buffers[name][time]
+
+        table = []
+
+        if ancestral:
+            for time in reversed(range(self.num_timesteps)):
+                start_from_x, start_from_out = self.start_coefficients_from(buffers, time)
+
+                table.append(SamplingStep(
+                    time,
+                    start_from_x,
+                    start_from_out,
+                    get('posterior_mean_coef1', time),
+                    get('posterior_mean_coef2', time),
+                    math.exp(0.5 * get('posterior_log_variance_clipped', time)) if time > 0 else 0.
+                ))
+        else:
+            times = self.ddim_times(sampling_timesteps)
+
+            for time, time_next in zip(times[:-1], times[1:]):
+                start_from_x, start_from_out = self.start_coefficients_from(buffers, time)
+
+                if time_next < 0:
+                    table.append(SamplingStep(time, start_from_x, start_from_out, 1., 0., 0.))
+                    continue
+
+                alpha = get('alphas_cumprod', time)
+                alpha_next = get('alphas_cumprod', time_next)
+
+                sigma = eta * math.sqrt((1 - alpha / alpha_next) * (1 - alpha_next) / (1 - alpha))
+                c = math.sqrt(1 - alpha_next - sigma ** 2)
+
+                # pred_noise rederived from the clipped x_start, (sqrt_recip * x - x_start) / sqrt_recipm1, folded into the update
+
+                recip, recipm1 = get('sqrt_recip_alphas_cumprod', time), get('sqrt_recipm1_alphas_cumprod', time)
+
+                table.append(SamplingStep(
+                    time,
+                    start_from_x,
+                    start_from_out,
+                    math.sqrt(alpha_next) - c / recipm1,
+                    c * recip / recipm1,
+                    sigma
+                ))
+
+        self.sampling_tables[key] = table
+        return table
+
+    def start_coefficients_from(self, buffers, time):
+        if self.objective == 'pred_noise':
+            return buffers['sqrt_recip_alphas_cumprod'][time], -buffers['sqrt_recipm1_alphas_cumprod'][time]
+        elif self.objective == 'pred_x0':
+            return 0., 1.
+        elif self.objective == 'pred_v':
+            return buffers['sqrt_alphas_cumprod'][time], -buffers['sqrt_one_minus_alphas_cumprod'][time]
+
+    def dpm_solver_table(self, steps, order = 2):
+        """
+        multistep dpm-solver++ (https://arxiv.org/abs/2211.01095) in data (x_start) prediction form, on `steps` timesteps uniform in [T - 1, 0]
+        the first steps warm up from first order, and with fewer than 15 steps the last ones fall back to lower order for stability
+        """
+        assert 1 <= order <= 3, 'dpm-solver++ order must be 1, 2 or 3'
+        assert 0 < steps <= self.num_timesteps
+
+        key = ('dpm_solver', steps, order)
+
+        if key in self.sampling_tables:
+            return self.sampling_tables[key]
+
+        alphas_cumprod = self.alphas_cumprod.double().tolist()
+
+        alpha = lambda t: math.sqrt(alphas_cumprod[t])
+        sigma = lambda t: math.sqrt(1. - alphas_cumprod[t])
+        lamb = lambda t: math.log(alpha(t) / sigma(t))
+
+        times = torch.linspace(self.num_timesteps - 1, 0, steps).round().long().tolist()
+
+        table = []
+
+        for i, (time, time_next) in enumerate(zip(times[:-1], times[1:])):
+            step_order = min(order, i + 1)
+
+            if steps < 15:
+                step_order = min(step_order, len(times) - 1 - i)
+
+            h = lamb(time_next) - lamb(time)
+            alpha_next = alpha(time_next)
+            em1 = math.expm1(-h)
+
+            x_coef = sigma(time_next) / sigma(time)
+            a = -alpha_next * em1
+
+            if step_order == 1:
+                start_coefs = (a,)
+
+            elif step_order == 2:
+                r0 = (lamb(time) - lamb(times[i - 1])) / h
+                start_coefs = (a * (1. + 0.5 / r0), -0.5 * a / r0)
+
+            else:
+                r0 = (lamb(time) - lamb(times[i - 1])) / h
+                r1 = (lamb(times[i - 1]) - lamb(times[i - 2])) / h
+
+                b = alpha_next * (em1 / h + 1.)
+                c = -alpha_next * ((em1 + h) / h ** 2 - 0.5)
+
+                # b * D1 + c * D2 with D1 = (1 + k) * D1_0 - k * D1_1, D2 = (D1_0 - D1_1) / (r0 + r1), expanded over the buffered x_starts
+
+                k = r0 / (r0 + r1)
+                p = b * (1. + k) + c / (r0 + r1)
+                q = b * k + c / (r0 + r1)
+
+                start_coefs = (a + p / r0, -p / r0 - q / r1, q / r1)
+
+            table.append(DPMSolverStep(time, x_coef, start_coefs))
+
+        table.append(DPMSolverStep(times[-1], None, None))
+
+        self.sampling_tables[key] = table
+        return table
+
+    def cache_time_conditioning(self, times):
+        # lets the unet precompute its time conditioning for the timesteps of the active schedule and use it in the calling thread
+        # only call it within `time_cached` or a sampling loop, which restore what the unet used before
+
+        if hasattr(self.model, 'cache_time_conditioning'):
+            self.model.swap_time_cache(self.model.cache_time_conditioning([time for time in times if time >= 0]))
+
+    def swap_time_cache(self, cache):
+        if hasattr(self.model, 'swap_time_cache'):
+            return self.model.swap_time_cache(cache)
+
+        return None
+
+    @contextmanager
+    def time_cached(self, times):
+        # the model calls within use the time conditioning cached for the given timesteps
+
+        outer = self.swap_time_cache(None)
+
+        try:
+            self.cache_time_conditioning(times)
+            yield
+        finally:
+            self.swap_time_cache(outer)
+
+    def clear_time_cache(self):
+        if hasattr(self.model, 'clear_time_cache'):
+            self.model.clear_time_cache()
+
+    def table_sample_step(self, x, step: SamplingStep, x_self_cond = None):
+        time_cond = torch.full((x.shape[0],), step.time, device = x.device, dtype = torch.long)
+        model_output = self.model(x, time_cond, x_self_cond)
+
+        x_start = torch.add(model_output * step.start_from_out, x, alpha = step.start_from_x)
+        x_start.clamp_(-1., 1.)
+
+        x_next = torch.add(x_start * step.next_from_start, x, alpha = step.next_from_x)
+
+        if step.noise_scale > 0.:
+            x_next.add_(torch.randn_like(x), alpha = step.noise_scale)
+
+        return x_next, x_start
+
     def predict_start_from_noise(self, x_t, t, noise):
         return (
             extract(self.sqrt_recip_alphas_cumprod, t, x_t.shape) * x_t -
@@ -679,38 +1214,55 @@ class GaussianDiffusion(Module):
         pred_img = model_mean + (0.5 * model_log_variance).exp() * noise
         return pred_img, x_start
 
+    # sampling loops are generators of (t, x_t, x_start), t being the timestep of x_t and -1 for the final sample
+    # they start with (num_timesteps - 1, noise, None) and only hold the current step, see `sample_stream`
+
     @torch.inference_mode()
-    def p_sample_loop(self, shape, return_all_timesteps = False):
-        batch, device = shape[0], self.device
+    @scopes_time_cache
+    def p_sample_steps(self, shape):
+        self.cache_time_conditioning(range(self.num_timesteps))
 
-        img = torch.randn(shape, device = device)
-        imgs = [img]
+        img = to_memory_format(torch.randn(shape, device = self.device), self.memory_format)
+        yield self.num_timesteps - 1, img, None
 
         x_start = None
 
-        for t in tqdm(reversed(range(0, self.num_timesteps)), desc = 'sampling loop time step', total = self.num_timesteps):
-            self_cond = x_start if self.self_condition else None
-            img, x_start = self.p_sample(img, t, self_cond)
-            imgs.append(img)
-
-        ret = img if not return_all_timesteps else torch.stack(imgs, dim = 1)
-
-        ret = self.unnormalize(ret)
-        return ret
+        if self.can_use_sampling_tables:
+            for step in tqdm(self.sampling_table(ancestral = True), desc = 'sampling loop time step'):
+                self_cond = x_start if self.self_condition else None
+                img, x_start = self.table_sample_step(img, step, self_cond)
+                yield step.time - 1, img, x_start
+        else:
+            for t in tqdm(reversed(range(0, self.num_timesteps)), desc = 'sampling loop time step', total = self.num_timesteps):
+                self_cond = x_start if self.self_condition else None
+                img, x_start = self.p_sample(img, t, self_cond)
+                yield t - 1, img, x_start
 
     @torch.inference_mode()
-    def ddim_sample(self, shape, return_all_timesteps = False):
+    @scopes_time_cache
+    def ddim_sample_steps(self, shape):
         batch, device, total_timesteps, sampling_timesteps, eta, objective = shape[0], self.device, self.num_timesteps, self.sampling_timesteps, self.ddim_sampling_eta, self.objective
 
-        times = torch.linspace(-1, total_timesteps - 1, steps = sampling_timesteps + 1)   # [-1, 0, 1, 2, ..., T-1] when sampling_timesteps == total_timesteps
-        times = list(reversed(times.int().tolist()))
+        times = self.ddim_times(sampling_timesteps)
         time_pairs = list(zip(times[:-1], times[1:])) # [(T-1, T-2), (T-2, T-3), ..., (1, 0), (0, -1)]
 
-        img = torch.randn(shape, device = device)
-        imgs = [img]
+        self.cache_time_conditioning(times)
+
+        img = to_memory_format(torch.randn(shape, device = device), self.memory_format)
+        yield times[0], img, None
 
         x_start = None
 
+        if self.can_use_sampling_tables:
+            table = self.sampling_table(sampling_timesteps, eta)
+
+            for step, (_, time_next) in tqdm(zip(table, time_pairs), desc = 'sampling loop time step', total = len(table)):
+                self_cond = x_start if self.self_condition else None
+                img, x_start = self.table_sample_step(img, step, self_cond)
+                yield time_next, img, x_start
+
+            return
+
         for time, time_next in tqdm(time_pairs, desc = 'sampling loop time step'):
             time_cond = torch.full((batch,), time, device = device, dtype = torch.long)
             self_cond = x_start if self.self_condition else None
@@ -718,7 +1270,7 @@ class GaussianDiffusion(Module):
 
             if time_next < 0:
                 img = x_start
-                imgs.append(img)
+                yield time_next, img, x_start
                 continue
 
             alpha = self.alphas_cumprod[time]
@@ -733,18 +1285,224 @@ class GaussianDiffusion(Module):
                   c * pred_noise + \
                   sigma * noise
 
-            imgs.append(img)
+            yield time_next, img, x_start
+
+    @torch.inference_mode()
+    @scopes_time_cache
+    def dpm_solver_sample_steps(self, shape, steps = 20, order = 2):
+        batch, device = shape[0], self.device
+        table = self.dpm_solver_table(steps, order)
+
+        self.cache_time_conditioning([step.time for step in table])
+
+        img = to_memory_format(torch.randn(shape, device = device), self.memory_format)
+        yield table[0].time, img, None
+
+        x_start = None
+        x_starts = [] # most recent first, the model outputs reused by the multistep updates
+
+        for step, next_step in tqdm(zip(table, table[1:] + [None]), desc = 'sampling loop time step', total = len(table)):
+            time_cond = torch.full((batch,), step.time, device = device, dtype = torch.long)
+            self_cond = x_start if self.self_condition else None
+            _, x_start, *_ = self.model_predictions(img, time_cond, self_cond, clip_x_start = True)
+
+            if not exists(step.start_coefs):
+                img = x_start
+                yield -1, img, x_start
+                break
+
+            x_starts.insert(0, x_start)
+            del x_starts[order:]
+
+            img = img * step.x_coef
 
-        ret = img if not return_all_timesteps else torch.stack(imgs, dim = 1)
+            for coef, buffered_x_start in zip(step.start_coefs, x_starts):
+                img.add_(buffered_x_start, alpha = coef)
+
+            yield next_step.time, img, x_start
+
+    @torch.inference_mode()
+    @scopes_time_cache
+    def picard_sample_steps(self, shape, window_size = 8, tolerance = 1e-3):
+        """
+        parallel in time sampling by picard iteration (https://arxiv.org/abs/2305.16317) over the ancestral or ddim sampling table
+
+        the trajectory x_{i+1} = x_i + d_i(x_i) is iterated as a fixed point over a window of `window_size` consecutive steps
+        every iteration evaluates the unet for the whole window in one batched call, then sets x_{s+k+1} = x_s + sum of d_{s..s+k}
+        the window slides past its first step, which is then exact, and every following step whose update moved by less than `tolerance` (root mean square)
+        the noise of every step is drawn once when it enters the window, so it converges to the sequential trajectory with that noise
+        """
+        assert self.can_use_sampling_tables, 'picard sampling needs the precomputed sampling tables of GaussianDiffusion'
+
+        table = self.sampling_table(self.sampling_timesteps, self.ddim_sampling_eta) if self.is_ddim_sampling else self.sampling_table(ancestral = True)
+        num_steps, batch, device = len(table), shape[0], self.device
+
+        self.cache_time_conditioning([step.time for step in table])
+
+        times = torch.tensor([step.time for step in table], device = device)
+        next_times = [step.time for step in table[1:]] + [-1]
+        coefs = {name: torch.tensor([getattr(step, name) for step in table], device = device) for name in SamplingStep._fields[1:]}
+
+        window_size = min(window_size, num_steps)
+        expand = lambda t, n: repeat(t, '... -> n ...', n = n)
+
+        img = to_memory_format(torch.randn(shape, device = device), self.memory_format)
+        yield table[0].time, img, None
+
+        # xs[k] is the current guess of x_{start + k}, xs[0] being exact, and noises[k] the noise of step start + k
+        # the window buffers are laid out like img per window entry, so the batched unet input stays in its memory format
+
+        images = lambda t: to_memory_format(t, self.memory_format)
+
+        xs = images(expand(img, window_size + 1).clone())
+        noises = images(torch.randn((window_size, *shape), device = device))
+
+        # while self conditioning, step start + k is conditioned on the x_start its previous step predicted in the last iteration
+
+        x_starts = images(torch.zeros((window_size, *shape), device = device))
+        first_self_cond = images(torch.zeros(shape, device = device))
+
+        start = iterations = evaluations = 0
+
+        while start < num_steps:
+            w = min(window_size, num_steps - start)
+            index = torch.arange(start, start + w, device = device)
+
+            coef = lambda name: rearrange(coefs[name][index], 'w -> w 1 1 1 1')
+
+            x_window = xs[:w]
+
+            self_cond = None
+
+            if self.self_condition:
+                self_cond = torch.cat((first_self_cond[None], x_starts[:(w - 1)]))
+                self_cond = rearrange(self_cond, 'w b ... -> (w b) ...')
+
+            model_output = self.model(rearrange(x_window, 'w b ... -> (w b) ...'), repeat(times[index], 'w -> (w b)', b = batch), self_cond)
+            model_output = rearrange(model_output, '(w b) ... -> w b ...', w = w)
+
+            x_start = model_output * coef('start_from_out') + x_window * coef('start_from_x')
+            x_start.clamp_(-1., 1.)
+
+            x_next = x_start * coef('next_from_start') + x_window * coef('next_from_x') + noises[:w] * coef('noise_scale')
+
+            new_xs = xs[0] + (x_next - x_window).cumsum(dim = 0)
+            error = (new_xs - xs[1:(w + 1)]).pow(2).mean(dim = (2, 3, 4)).sqrt().amax(dim = 1)
+
+            xs[1:(w + 1)] = new_xs
+            x_starts[:w] = x_start
+
+            iterations += 1
+            evaluations += w
+
+            # slide past the exact first step and every following converged one
+
+            unconverged = (error[1:] > tolerance).tolist()
+            num_converged = 1 + unconverged.index(True) if True in unconverged else w
+
+            for k in range(num_converged):
+                yield next_times[start + k], new_xs[k].clone(), x_start[k].clone()
+
+            start += num_converged
+            first_self_cond = x_start[num_converged - 1]
+
+            slide_window(xs, num_converged, xs[-1].clone())
+            slide_window(x_starts, num_converged, x_starts[-1].clone())
+            slide_window(noises, num_converged, torch.randn((num_converged, *shape), device = device))
+
+        self.sampling_stats.update(picard = dict(steps = num_steps, iterations = iterations, model_evaluations = evaluations, window_size = window_size, tolerance = tolerance))
+
+    def collect_steps(self, steps, return_all_timesteps = False):
+        imgs = []
+
+        for _, img, _ in steps:
+            if return_all_timesteps:
+                imgs.append(img)
+            else:
+                imgs = [img]
+
+        ret = imgs[-1] if not return_all_timesteps else torch.stack(imgs, dim = 1)
 
         ret = self.unnormalize(ret)
         return ret
 
     @torch.inference_mode()
-    def sample(self, batch_size = 16, return_all_timesteps = False):
+    def p_sample_loop(self, shape, return_all_timesteps = False):
+        return self.collect_steps(self.p_sample_steps(shape), return_all_timesteps)
+
+    @torch.inference_mode()
+    def ddim_sample(self, shape, return_all_timesteps = False):
+        return self.collect_steps(self.ddim_sample_steps(shape), return_all_timesteps)
+
+    @torch.inference_mode()
+    def dpm_solver_sample(self, shape, steps = 20, order = 2, return_all_timesteps = False):
+        return self.collect_steps(self.dpm_solver_sample_steps(shape, steps, order), return_all_timesteps)
+
+    def deep_cached_steps(self, steps, deep_cache):
+        assert hasattr(self.model, 'deep_cache'), 'deep feature reuse needs the Unet of this repository'
+
+        deep_cache.reset()
+        self.model.deep_cache = deep_cache
+
+        try:
+            yield from steps
+        finally:
+            self.model.deep_cache = None
+            self.sampling_stats.update(deep_cache = deep_cache.stats)
+
+    def sample_steps(self, batch_size = 16, sampler = None, sampling_timesteps = None, solver_order = 2, deep_cache = None, picard_window_size = 8, picard_tolerance = 1e-3):
         (h, w), channels = self.image_size, self.channels
-        sample_fn = self.p_sample_loop if not self.is_ddim_sampling else self.ddim_sample
-        return sample_fn((batch_size, channels, h, w), return_all_timesteps = return_all_timesteps)
+        shape = (batch_size, channels, h, w)
+
+        # stats of this run, each sampler and the deep feature cache add their own entry
+
+        self.sampling_stats = dict()
+
+        assert not exists(sampling_timesteps) or sampler == 'dpm_solver', 'sampling_timesteps only applies to the dpm_solver sampler, use `set_sampling_timesteps` for ddim and picard sampling'
+
+        if sampler == 'dpm_solver':
+            steps = default(sampling_timesteps, self.sampling_timesteps if self.is_ddim_sampling else 20)
+            steps = self.dpm_solver_sample_steps(shape, steps = steps, order = solver_order)
+        elif sampler == 'picard':
+            steps = self.picard_sample_steps(shape, window_size = picard_window_size, tolerance = picard_tolerance)
+        else:
+            assert not exists(sampler), f'unknown sampler {sampler}'
+            steps = self.p_sample_steps(shape) if not self.is_ddim_sampling else self.ddim_sample_steps(shape)
+
+        if exists(deep_cache):
+            steps = self.deep_cached_steps(steps, deep_cache)
+
+        return steps
+
+    @torch.inference_mode()
+    def sample(self, batch_size = 16, return_all_timesteps = False, sampler = None, sampling_timesteps = None, solver_order = 2, deep_cache = None, picard_window_size = 8, picard_tolerance = 1e-3):
+        """
+        sampler - None for ancestral or ddim sampling as configured at init, 'dpm_solver' for the multistep dpm-solver++ of order `solver_order`,
+                  or 'picard' for the configured ancestral or ddim sampling run parallel in time over windows of `picard_window_size` steps, see `picard_sample_steps`
+        sampling_timesteps - number of model evaluations for dpm_solver (only), defaults to the ddim sampling timesteps if set, else 20
+        deep_cache - optional DeepFeatureCache, reusing the deep unet features between its refreshes, with its stats left in `sampling_stats`
+        """
+        steps = self.sample_steps(batch_size, sampler = sampler, sampling_timesteps = sampling_timesteps, solver_order = solver_order, deep_cache = deep_cache, picard_window_size = picard_window_size, picard_tolerance = picard_tolerance)
+        return self.collect_steps(steps, return_all_timesteps)
+
+    @torch.inference_mode()
+    def sample_stream(self, batch_size = 16, stride = 1, predicate = None, **sample_kwargs):
+        """
+        streams (t, x_t, x_start) of one sampling run, unnormalized like `sample`, with t == -1 for the final sample (x_start is None for the initial noise)
+        yields every `stride`-th step plus the final sample, or only the steps where `predicate(t)` is true
+        memory stays constant in the number of steps, so frames can be written to disk or a video encoder as they come
+        takes the same sampler arguments as `sample`
+        """
+        for i, (t, img, x_start) in enumerate(self.sample_steps(batch_size, **sample_kwargs)):
+            if exists(predicate):
+                keep = predicate(t)
+            else:
+                keep = divisible_by(i, stride) or t < 0
+
+            if not keep:
+                continue
+
+            yield t, self.unnormalize(img), self.unnormalize(x_start) if exists(x_start) else None
 
     @torch.inference_mode()
     def interpolate(self, x1, x2, t = None, lam = 0.5):
@@ -842,6 +1600,58 @@ class GaussianDiffusion(Module):
 
 # dataset classes
 
+class SharedImageCache:
+    """
+    decoded uint8 images in shared memory, so all dataloader workers read and fill one copy
+    holds as many images as fit in `max_bytes`, evicting the least recently used one when full
+    """
+
+    def __init__(self, num_items, item_shape, max_bytes):
+        item_bytes = math.prod(item_shape)
+        self.num_slots = min(num_items, max_bytes // item_bytes)
+        assert self.num_slots > 0, f'cache budget of {max_bytes} bytes cannot hold a single image of {item_bytes} bytes'
+
+        self.slots = torch.empty((self.num_slots, *item_shape), dtype = torch.uint8).share_memory_()
+
+        self.slot_of_item = torch.full((num_items,), -1, dtype = torch.long).share_memory_()
+        self.item_of_slot = torch.full((self.num_slots,), -1, dtype = torch.long).share_memory_()
+        self.last_used = torch.full((self.num_slots,), -1, dtype = torch.long).share_memory_()
+        self.clock = torch.zeros(1, dtype = torch.long).share_memory_()
+
+        self.lock = mp.Lock()
+
+    def tick(self):
+        self.clock += 1
+        return self.clock.item()
+
+    def get(self, index):
+        with self.lock:
+            slot = self.slot_of_item[index].item()
+
+            if slot < 0:
+                return None
+
+            self.last_used[slot] = self.tick()
+            return self.slots[slot].clone()
+
+    def put(self, index, item):
+        with self.lock:
+            if self.slot_of_item[index] >= 0:
+                return
+
+            # empty slots are never used (-1), so they are filled before anything is evicted
+
+            slot = self.last_used.argmin().item()
+            evicted = self.item_of_slot[slot].item()
+
+            if evicted >= 0:
+                self.slot_of_item[evicted] = -1
+
+            self.slots[slot].copy_(item)
+            self.item_of_slot[slot] = index
+            self.slot_of_item[index] = slot
+            self.last_used[slot] = self.tick()
+
 class Dataset(Dataset):
     def __init__(
         self,
@@ -849,12 +1659,25 @@ class Dataset(Dataset):
         image_size,
         exts = ['jpg', 'jpeg', 'png', 'tiff'],
         augment_horizontal_flip = False,
-        convert_image_to = None
+        convert_image_to = None,
+        draft_decode = False,
+        image_cache_bytes = 0,
+        uint8_output = False,
+        use_manifest = False,
+        manifest_path = None
     ):
         super().__init__()
         self.folder = folder
         self.image_size = image_size
-        self.paths = [p for ext in exts for p in Path(f'{folder}').glob(f'**/*.{ext}')]
+        self.draft_decode = draft_decode
+
+        # a persisted file manifest, revalidated by directory mtimes, avoids the full recursive glob on every construction
+
+        if use_manifest:
+            manifest = FileManifest(folder, manifest_path).refresh()
+            self.paths = [p for ext in exts for p, *_ in manifest.files(ext)]
+        else:
+            self.paths = [p for ext in exts for p in Path(f'{folder}').glob(f'**/*.{ext}')]
 
         maybe_convert_fn = partial(convert_image_to_fn, convert_image_to) if exists(convert_image_to) else nn.Identity()
 
@@ -866,13 +1689,62 @@ class Dataset(Dataset):
             T.ToTensor()
         ])
 
+        # uint8 pipeline of resized and cropped images, with flip and float conversion split off
+        # used by the shared image cache, and returned as is with `uint8_output` so the trainer can augment whole batches
+
+        self.uint8_output = uint8_output
+
+        self.cache_transform = T.Compose([
+            T.Lambda(maybe_convert_fn),
+            T.Resize(image_size),
+            T.CenterCrop(image_size),
+            T.PILToTensor()
+        ])
+
+        self.cached_transform = T.Compose([
+            T.RandomHorizontalFlip() if augment_horizontal_flip else nn.Identity(),
+            T.ConvertImageDtype(torch.float)
+        ])
+
+        # optional shared cache of decoded uint8 images
+
+        self.cache = None
+
+        if image_cache_bytes > 0 and len(self.paths) > 0:
+            channels = {'L': 1, 'RGB': 3, 'RGBA': 4}.get(convert_image_to)
+            assert exists(channels), 'convert_image_to must be one of L, RGB or RGBA when caching images, so every image has the same shape'
+
+            h, w = image_size if isinstance(image_size, (tuple, list)) else (image_size, image_size)
+            self.cache = SharedImageCache(len(self.paths), (channels, h, w), image_cache_bytes)
+
     def __len__(self):
         return len(self.paths)
 
-    def __getitem__(self, index):
+    def load(self, index):
         path = self.paths[index]
         img = Image.open(path)
-        return self.transform(img)
+
+        if self.draft_decode:
+            img = draft_image(img, self.image_size)
+
+        return img
+
+    def __getitem__(self, index):
+        if not exists(self.cache) and not self.uint8_output:
+            return self.transform(self.load(index))
+
+        img = self.cache.get(index) if exists(self.cache) else None
+
+        if not exists(img):
+            img = self.cache_transform(self.load(index))
+
+            if exists(self.cache):
+                self.cache.put(index, img)
+
+        if self.uint8_output:
+            return img
+
+        return self.cached_transform(img)
 
 # trainer class
 
@@ -901,7 +1773,13 @@ class Trainer:
         inception_block_idx = 2048,
         max_grad_norm = 1.,
         num_fid_samples = 50000,
-        save_best_and_latest_only = False
+        save_best_and_latest_only = False,
+        draft_decode = False,
+        image_cache_bytes = 0,
+        batch_augment = False,
+        use_manifest = False,
+        checkpoint_stages = False,
+        channels_last = False
     ):
         super().__init__()
 
@@ -918,6 +1796,19 @@ class Trainer:
         self.channels = diffusion_model.channels
         is_ddim_sampling = diffusion_model.is_ddim_sampling
 
+        # activation checkpointing of the unet stages - True for all, or stage names, see Unet.set_checkpointing
+
+        if checkpoint_stages:
+            assert hasattr(diffusion_model.model, 'set_checkpointing'), 'activation checkpointing needs the Unet of this repository'
+            diffusion_model.model.set_checkpointing(checkpoint_stages)
+
+        # channels last unet weights and training batches, see GaussianDiffusion.set_channels_last
+
+        if channels_last:
+            diffusion_model.set_channels_last()
+
+        self.memory_format = diffusion_model.memory_format
+
         # default convert_image_to depending on channels
 
         if not exists(convert_image_to):
@@ -939,8 +1830,12 @@ class Trainer:
         self.max_grad_norm = max_grad_norm
 
         # dataset and dataloader
+        # with batch_augment, workers return uint8 images and flip + float conversion run once per batch in `augment_batch`
 
-        self.ds = Dataset(folder, self.image_size, augment_horizontal_flip = augment_horizontal_flip, convert_image_to = convert_image_to)
+        self.batch_augment = batch_augment
+        self.augment_horizontal_flip = augment_horizontal_flip
+
+        self.ds = Dataset(folder, self.image_size, augment_horizontal_flip = augment_horizontal_flip, convert_image_to = convert_image_to, draft_decode = draft_decode, image_cache_bytes = image_cache_bytes, uint8_output = batch_augment, use_manifest = use_manifest)
 
         assert len(self.ds) >= 100, 'you should have at least 100 images in your folder. at least 10k images recommended'
 
@@ -985,7 +1880,7 @@ class Trainer:
 
             self.fid_scorer = FIDEvaluation(
                 batch_size=self.batch_size,
-                dl=self.dl,
+                dl=map(self.augment_batch, self.dl) if batch_augment else self.dl,
                 sampler=self.ema.ema_model,
                 channels=self.channels,
                 accelerator=self.accelerator,
@@ -1005,6 +1900,15 @@ class Trainer:
     def device(self):
         return self.accelerator.device
 
+    def augment_batch(self, images):
+        images = images.float().div_(255)
+
+        if self.augment_horizontal_flip:
+            flip = torch.rand(images.shape[0], device = images.device) < 0.5
+            images = torch.where(rearrange(flip, 'b -> b 1 1 1'), images.flip(-1), images)
+
+        return images
+
     def save(self, milestone):
         if not self.accelerator.is_local_main_process:
             return
@@ -1029,6 +1933,14 @@ class Trainer:
         model = self.accelerator.unwrap_model(self.model)
         model.load_state_dict(data['model'])
 
+        if 'sampling_timesteps' in data:
+            # progressively distilled checkpoints sample deterministically with the step count they were distilled to
+
+            model.set_sampling_timesteps(data['sampling_timesteps'], ddim_sampling_eta = 0.)
+
+            if self.accelerator.is_main_process:
+                self.ema.ema_model.set_sampling_timesteps(data['sampling_timesteps'], ddim_sampling_eta = 0.)
+
         self.step = data['step']
         self.opt.load_state_dict(data['opt'])
         if self.accelerator.is_main_process:
@@ -1054,6 +1966,11 @@ class Trainer:
                 for _ in range(self.gradient_accumulate_every):
                     data = next(self.dl).to(device)
 
+                    if self.batch_augment:
+                        data = self.augment_batch(data)
+
+                    data = data.contiguous(memory_format = self.memory_format)
+
                     with self.accelerator.autocast():
                         loss = self.model(data)
                         loss = loss / self.gradient_accumulate_every
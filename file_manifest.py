@@ -0,0 +1,130 @@
+import os
+import json
+import hashlib
+import warnings
+from pathlib import Path
+
+# constants
+
+MANIFEST_VERSION = 1
+
+DEFAULT_MANIFEST_DIR = Path(os.environ.get('XDG_CACHE_HOME', Path.home() / '.cache')) / 'denoising_diffusion_pytorch' / 'manifests'
+
+# helpers
+
+def exists(val):
+    return val is not None
+
+def default(val, d):
+    return val if exists(val) else d
+
+def scan_dir(path):
+    files, subdirs = [], []
+
+    with os.scandir(path) as entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks = False):
+                subdirs.append(entry.name)
+            elif entry.is_file():
+                stat = entry.stat()
+                files.append([entry.name, stat.st_size, stat.st_mtime_ns])
+
+    return dict(files = sorted(files), subdirs = sorted(subdirs))
+
+# main class
+
+class FileManifest:
+    """
+    cached recursive listing of a folder, with the size and mtime of every file
+
+    on refresh only directories are stat-ed - a directory whose mtime is unchanged reuses its cached listing, any other is rescanned
+    so added, removed and renamed files are picked up, while files rewritten in place keep the size and mtime they were listed with
+
+    the manifest is stored outside the folder (by default under ~/.cache), so writing it never changes the directory mtimes it validates against
+    `exclude` are subdirectories (paths relative to the root) that are neither listed nor descended into, such as caches derived from the files
+    """
+
+    def __init__(self, root, manifest_path = None, exclude = ()):
+        self.root = Path(root).resolve()
+        self.exclude = {Path(os.path.relpath(self.root / path, self.root)).as_posix() for path in exclude}
+
+        default_manifest_path = DEFAULT_MANIFEST_DIR / f'{hashlib.sha1(str(self.root).encode()).hexdigest()}.json'
+        self.manifest_path = Path(default(manifest_path, default_manifest_path))
+
+        self.dirs = self.load()
+
+    def load(self):
+        try:
+            with open(self.manifest_path) as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return dict()
+
+        if data.get('version') != MANIFEST_VERSION or data.get('root') != str(self.root):
+            return dict()
+
+        return data['dirs']
+
+    def save(self):
+        data = dict(version = MANIFEST_VERSION, root = str(self.root), dirs = self.dirs)
+        tmp_path = self.manifest_path.with_name(self.manifest_path.name + '.tmp')
+
+        try:
+            self.manifest_path.parent.mkdir(parents = True, exist_ok = True)
+
+            with open(tmp_path, 'w') as f:
+                json.dump(data, f)
+
+            os.replace(tmp_path, self.manifest_path)
+        except OSError as e:
+            warnings.warn(f'could not write file manifest to {self.manifest_path}: {e}')
+
+    def refresh(self):
+        """ revalidate against the directory mtimes, rescanning changed directories, and save if anything changed """
+        dirs = dict()
+        stack = ['.']
+
+        while stack:
+            rel_dir = stack.pop()
+
+            try:
+                mtime = os.stat(self.root / rel_dir).st_mtime_ns
+            except FileNotFoundError:
+                continue
+
+            entry = self.dirs.get(rel_dir)
+
+            if not exists(entry) or entry['mtime'] != mtime:
+                entry = dict(mtime = mtime, **scan_dir(self.root / rel_dir))
+
+            dirs[rel_dir] = entry
+
+            subdirs = (name if rel_dir == '.' else f'{rel_dir}/{name}' for name in entry['subdirs'])
+            stack.extend(subdir for subdir in subdirs if subdir not in self.exclude)
+
+        changed = dirs != self.dirs
+        self.dirs = dirs
+
+        if changed:
+            self.save()
+
+        return self
+
+    def files(self, ext = None):
+        """ yields (path, size, mtime_ns) of every listed file, optionally only those ending in .{ext} """
+        suffix = f'.{ext}' if exists(ext) else ''
+
+        for rel_dir in sorted(self.dirs.keys()):
+            for name, size, mtime in self.dirs[rel_dir]['files']:
+                if name.endswith(suffix):
+                    yield self.root / rel_dir / name, size, mtime
+
+    def stats(self):
+        """ dictionary of posix path relative to the root -> (size, mtime_ns) """
+        stats = dict()
+
+        for rel_dir, entry in self.dirs.items():
+            for name, size, mtime in entry['files']:
+                stats[name if rel_dir == '.' else f'{rel_dir}/{name}'] = (size, mtime)
+
+        return stats
@@ -0,0 +1,309 @@
+import math
+import copy
+from pathlib import Path
+from multiprocessing import cpu_count
+
+import torch
+import torch.nn.functional as F
+from torch.nn import Module
+from torch.optim import Adam
+from torch.optim.lr_scheduler import LambdaLR
+from torch.utils.data import DataLoader
+
+from torchvision import utils
+
+from einops import rearrange, reduce
+
+from tqdm.auto import tqdm
+from ema_pytorch import EMA
+
+from accelerate import Accelerator
+
+from denoising_diffusion_pytorch.denoising_diffusion_pytorch import Dataset, exists, default, cycle, has_int_squareroot, num_to_groups
+
+from denoising_diffusion_pytorch.version import __version__
+
+# progressive distillation (https://arxiv.org/abs/2202.00512)
+# a student initialized from the teacher learns to take in one deterministic ddim step what the teacher takes in two
+# the student then becomes the teacher for the next stage, halving the number of sampling steps every stage
+
+# helpers
+
+def alpha_sigma(diffusion, t):
+    # time -1 is the clean image, with alpha 1 and sigma 0
+
+    alphas_cumprod = F.pad(diffusion.alphas_cumprod, (1, 0), value = 1.)
+    alpha_cumprod = rearrange(alphas_cumprod[t + 1], 'b -> b 1 1 1')
+    return alpha_cumprod.sqrt(), (1. - alpha_cumprod).sqrt()
+
+def ddim_step(diffusion, x, t, t_next, x_start):
+    alpha, sigma = alpha_sigma(diffusion, t)
+    alpha_next, sigma_next = alpha_sigma(diffusion, t_next)
+
+    pred_noise = (x - alpha * x_start) / sigma
+    return alpha_next * x_start + sigma_next * pred_noise
+
+def is_power_of_two_multiple(numer, denom):
+    ratio = numer // denom
+    return numer % denom == 0 and ratio > 1 and (ratio & (ratio - 1)) == 0
+
+def distillation_stages(num_timesteps, final_sampling_timesteps, start_sampling_timesteps = None):
+    """
+    student step counts of every stage, the teacher of each taking twice as many
+    the first teacher defaults to the largest power of two multiple of the final step count that the training timesteps allow, 512 for 1000 timesteps and 8 final steps
+    """
+    start = default(start_sampling_timesteps, final_sampling_timesteps * 2 ** int(math.log2(num_timesteps // final_sampling_timesteps)))
+
+    assert start <= num_timesteps, 'the first teacher cannot take more steps than there are timesteps'
+    assert is_power_of_two_multiple(start, final_sampling_timesteps), 'the first teacher step count must be a power of two multiple of the final step count'
+
+    stages = []
+
+    while start > final_sampling_timesteps:
+        start //= 2
+        stages.append(start)
+
+    return stages
+
+def load_distilled(diffusion, path):
+    """ loads a stage checkpoint into the GaussianDiffusion and sets it to sample with the step count of that stage """
+    data = torch.load(str(path), map_location = diffusion.device, weights_only = True)
+
+    diffusion.load_state_dict(data['model'])
+    diffusion.set_sampling_timesteps(data['sampling_timesteps'], ddim_sampling_eta = 0.)
+    return diffusion
+
+class StudentPrediction(Module):
+    """ the student's x_start prediction as a forward, so that a distributed wrapper from the accelerator sees it and all-reduces the gradients """
+
+    def __init__(self, student):
+        super().__init__()
+        self.student = student
+
+    def forward(self, x, t):
+        return self.student.model_predictions(x, t).pred_x_start
+
+# trainer class
+
+class DistillationTrainer:
+    def __init__(
+        self,
+        diffusion_model,
+        folder,
+        *,
+        final_sampling_timesteps = 8,
+        start_sampling_timesteps = None,
+        train_num_steps_per_stage = 50000,
+        train_batch_size = 16,
+        gradient_accumulate_every = 1,
+        augment_horizontal_flip = True,
+        train_lr = 1e-4,
+        ema_update_every = 10,
+        ema_decay = 0.995,
+        adam_betas = (0.9, 0.99),
+        num_samples = 25,
+        results_folder = './results',
+        amp = False,
+        mixed_precision_type = 'fp16',
+        split_batches = True,
+        convert_image_to = None,
+        max_grad_norm = 1.
+    ):
+        """
+        diffusion_model - the trained teacher GaussianDiffusion, it is left unchanged
+        each stage trains for `train_num_steps_per_stage` steps with the learning rate decaying linearly to zero, and saves model-distilled-{steps}.pt in the results folder
+        stage checkpoints load with `Trainer.load('distilled-{steps}')` or `load_distilled`, which set the sampler to the distilled step count
+        """
+        super().__init__()
+
+        assert not diffusion_model.self_condition, 'progressive distillation does not support self conditioning'
+
+        # accelerator
+
+        self.accelerator = Accelerator(
+            split_batches = split_batches,
+            mixed_precision = mixed_precision_type if amp else 'no'
+        )
+
+        # models
+
+        self.teacher = diffusion_model
+        self.channels = diffusion_model.channels
+        self.image_size = diffusion_model.image_size
+
+        if not exists(convert_image_to):
+            convert_image_to = {1: 'L', 3: 'RGB', 4: 'RGBA'}.get(self.channels)
+
+        # stages
+
+        self.stages = distillation_stages(diffusion_model.num_timesteps, final_sampling_timesteps, start_sampling_timesteps)
+
+        # sampling and training hyperparameters
+
+        assert has_int_squareroot(num_samples), 'number of samples must have an integer square root'
+        self.num_samples = num_samples
+
+        self.batch_size = train_batch_size
+        self.gradient_accumulate_every = gradient_accumulate_every
+        self.train_num_steps_per_stage = train_num_steps_per_stage
+
+        self.train_lr = train_lr
+        self.adam_betas = adam_betas
+        self.ema_kwargs = dict(beta = ema_decay, update_every = ema_update_every)
+        self.max_grad_norm = max_grad_norm
+
+        # dataset and dataloader
+
+        self.ds = Dataset(folder, self.image_size, augment_horizontal_flip = augment_horizontal_flip, convert_image_to = convert_image_to)
+
+        dl = DataLoader(self.ds, batch_size = train_batch_size, shuffle = True, pin_memory = True, num_workers = cpu_count())
+
+        dl = self.accelerator.prepare(dl)
+        self.dl = cycle(dl)
+
+        self.results_folder = Path(results_folder)
+        self.results_folder.mkdir(exist_ok = True)
+
+    @property
+    def device(self):
+        return self.accelerator.device
+
+    def checkpoint_path(self, sampling_timesteps):
+        return self.results_folder / f'model-distilled-{sampling_timesteps}.pt'
+
+    def distillation_loss(self, student_prediction, teacher, x_start, sampling_timesteps):
+        b, device = x_start.shape[0], x_start.device
+
+        times = torch.tensor(teacher.ddim_times(sampling_timesteps), device = device)
+        teacher_times = torch.tensor(teacher.ddim_times(sampling_timesteps * 2), device = device)
+
+        # a student step from t to t_next spans the teacher steps t -> t_mid -> t_next
+
+        i = torch.randint(0, sampling_timesteps, (b,), device = device)
+        t, t_mid, t_next = times[i], teacher_times[2 * i + 1], times[i + 1]
+
+        x = teacher.q_sample(x_start, t)
+
+        with torch.no_grad():
+            teacher_x_start = teacher.model_predictions(x, t, clip_x_start = True).pred_x_start
+            x_mid = ddim_step(teacher, x, t, t_mid, teacher_x_start)
+
+            teacher_x_start = teacher.model_predictions(x_mid, t_mid, clip_x_start = True).pred_x_start
+            x_next = ddim_step(teacher, x_mid, t_mid, t_next, teacher_x_start)
+
+        # the x_start for which a single ddim step from x lands on the teacher's x_next
+
+        alpha, sigma = alpha_sigma(teacher, t)
+        alpha_next, sigma_next = alpha_sigma(teacher, t_next)
+
+        ratio = sigma_next / sigma
+        target = (x_next - ratio * x) / (alpha_next - ratio * alpha)
+
+        pred = student_prediction(x, t)
+
+        # truncated snr weighting, max(snr, 1)
+
+        loss = F.mse_loss(pred, target, reduction = 'none')
+        loss = reduce(loss, 'b ... -> b', 'mean')
+
+        weight = (alpha ** 2 / sigma ** 2).clamp(min = 1.)
+        return (loss * weight.flatten()).mean()
+
+    def save(self, sampling_timesteps, step, opt, ema):
+        if not self.accelerator.is_local_main_process:
+            return
+
+        data = {
+            'step': step,
+            'model': ema.ema_model.state_dict(),
+            'opt': opt.state_dict(),
+            'ema': ema.state_dict(),
+            'scaler': self.accelerator.scaler.state_dict() if exists(self.accelerator.scaler) else None,
+            'sampling_timesteps': sampling_timesteps,
+            'version': __version__
+        }
+
+        torch.save(data, str(self.checkpoint_path(sampling_timesteps)))
+
+    def train_stage(self, teacher, sampling_timesteps):
+        accelerator = self.accelerator
+        device = accelerator.device
+
+        # the teacher is a frozen copy, so the model passed in is left unchanged
+
+        teacher = copy.deepcopy(teacher).to(device).eval().requires_grad_(False)
+
+        student = copy.deepcopy(teacher).requires_grad_(True)
+        student.set_sampling_timesteps(sampling_timesteps, ddim_sampling_eta = 0.)
+
+        opt = Adam(student.parameters(), lr = self.train_lr, betas = self.adam_betas)
+        scheduler = LambdaLR(opt, lambda step: 1. - step / self.train_num_steps_per_stage)
+
+        ema = EMA(student, **self.ema_kwargs)
+        ema.to(device)
+
+        # the loss goes through the prepared (possibly distributed) forward, the unwrapped student is only used by the ema
+
+        student_prediction, opt = accelerator.prepare(StudentPrediction(student), opt)
+
+        with tqdm(total = self.train_num_steps_per_stage, disable = not accelerator.is_main_process, desc = f'{sampling_timesteps * 2} -> {sampling_timesteps} steps') as pbar:
+
+            for step in range(self.train_num_steps_per_stage):
+                student_prediction.train()
+
+                total_loss = 0.
+
+                for _ in range(self.gradient_accumulate_every):
+                    data = next(self.dl).to(device)
+                    x_start = teacher.normalize(data)
+
+                    with accelerator.autocast():
+                        loss = self.distillation_loss(student_prediction, teacher, x_start, sampling_timesteps)
+                        loss = loss / self.gradient_accumulate_every
+                        total_loss += loss.item()
+
+                    accelerator.backward(loss)
+
+                pbar.set_description(f'{sampling_timesteps * 2} -> {sampling_timesteps} steps, loss: {total_loss:.4f}')
+
+                accelerator.wait_for_everyone()
+                accelerator.clip_grad_norm_(student_prediction.parameters(), self.max_grad_norm)
+
+                opt.step()
+                opt.zero_grad()
+                scheduler.step()
+
+                accelerator.wait_for_everyone()
+
+                ema.update()
+                pbar.update(1)
+
+        self.save(sampling_timesteps, self.train_num_steps_per_stage, opt, ema)
+
+        if accelerator.is_main_process:
+            ema.ema_model.eval()
+
+            with torch.inference_mode():
+                batches = num_to_groups(self.num_samples, self.batch_size)
+                all_images = torch.cat([ema.ema_model.sample(batch_size = n) for n in batches], dim = 0)
+
+            utils.save_image(all_images, str(self.results_folder / f'sample-distilled-{sampling_timesteps}.png'), nrow = int(math.sqrt(self.num_samples)))
+
+        return ema.ema_model
+
+    def train(self):
+        """ runs all stages, resuming after the last stage with a checkpoint, and returns the final student """
+        teacher = self.teacher
+
+        for sampling_timesteps in self.stages:
+            path = self.checkpoint_path(sampling_timesteps)
+
+            if path.exists():
+                teacher = load_distilled(copy.deepcopy(teacher), path)
+                self.accelerator.print(f'loaded distilled {sampling_timesteps} step model from {path}')
+                continue
+
+            teacher = self.train_stage(teacher, sampling_timesteps)
+
+        self.accelerator.print('distillation complete')
+        return teacher
@@ -0,0 +1,282 @@
+import copy
+import time
+import warnings
+
+import numpy as np
+import torch
+from torch import nn
+from torch.ao import quantization as tq
+from torch.nn.utils.fusion import fuse_conv_bn_eval
+
+from einops import rearrange
+from pytorch_fid.fid_score import calculate_frechet_distance
+from pytorch_fid.inception import InceptionV3
+
+from denoising_diffusion_pytorch.version import __version__
+
+# int8 cpu inference for the diffusion Unet and the segmentation ResUNet
+# Conv2d layers are statically quantized, with activation ranges calibrated on dataset batches, and Linear layers dynamically quantized
+# everything else (norms, attention, transposed convs, interpolation) stays in float
+
+# helpers
+
+def exists(val):
+    return val is not None
+
+def default(val, d):
+    if exists(val):
+        return val
+    return d() if callable(d) else d
+
+def to_float_images(images):
+    return images.float() / 255. if images.dtype == torch.uint8 else images.float()
+
+def timed(fn, *args):
+    start = time.perf_counter()
+    out = fn(*args)
+    return out, time.perf_counter() - start
+
+# model preparation
+
+class StaticQuantConv(nn.Module):
+    """ int8 conv between a quantize and a dequantize, so the float ops around it are unchanged """
+
+    def __init__(self, conv):
+        super().__init__()
+        self.quant = tq.QuantStub()
+        self.conv = conv
+        self.dequant = tq.DeQuantStub()
+
+    def forward(self, x):
+        return self.dequant(self.conv(self.quant(x)))
+
+def fuse_conv_bn(model):
+    """ folds every BatchNorm2d directly following a Conv2d into it, for Sequential neighbours and convN / bnN siblings as in torchvision's resnet """
+    for module in model.modules():
+        children = dict(module.named_children())
+        names = list(children.keys())
+
+        if isinstance(module, nn.Sequential):
+            pairs = list(zip(names[:-1], names[1:]))
+        else:
+            pairs = [(name, 'bn' + name[4:]) for name in names if name.startswith('conv') and ('bn' + name[4:]) in children]
+
+        for conv_name, bn_name in pairs:
+            conv, bn = children[conv_name], children[bn_name]
+
+            if not (isinstance(conv, nn.Conv2d) and isinstance(bn, nn.BatchNorm2d)):
+                continue
+
+            fused = fuse_conv_bn_eval(conv, bn)
+            setattr(module, conv_name, fused)
+            setattr(module, bn_name, nn.Identity())
+            children[conv_name], children[bn_name] = fused, None
+
+    return model
+
+def wrap_convs(module, qconfig):
+    for name, child in module.named_children():
+        if type(child) is nn.Conv2d:
+            wrapped = StaticQuantConv(child)
+            wrapped.qconfig = qconfig
+            setattr(module, name, wrapped)
+        else:
+            wrap_convs(child, qconfig)
+
+def prepare_int8(model, backend = 'x86'):
+    """ float copy of the model on cpu, with batchnorms fused and observers in place around every Conv2d, ready for calibration """
+    torch.backends.quantized.engine = backend
+
+    model = copy.deepcopy(model).cpu().eval()
+    fuse_conv_bn(model)
+    wrap_convs(model, tq.get_default_qconfig(backend))
+
+    return tq.prepare(model)
+
+def convert_int8(prepared):
+    model = tq.convert(prepared)
+    return tq.quantize_dynamic(model, {nn.Linear}, dtype = torch.qint8)
+
+# calibration
+
+@torch.no_grad()
+def calibrate_diffusion(prepared_unet, diffusion, dl, num_batches = 32):
+    """ runs the unet on training images noised to uniformly random timesteps, the inputs it sees while sampling """
+    for ind, images in enumerate(dl):
+        if ind == num_batches:
+            break
+
+        x_start = diffusion.normalize(to_float_images(images).to(diffusion.device))
+        t = torch.randint(0, diffusion.num_timesteps, (x_start.shape[0],), device = diffusion.device)
+        x, x_start, t = map(lambda tensor: tensor.cpu(), (diffusion.q_sample(x_start, t), x_start, t))
+
+        # while sampling, the self conditioning input is none on the first step and a predicted x_start afterwards
+
+        self_cond = x_start if diffusion.self_condition and ind % 2 == 1 else None
+        prepared_unet(x, t, self_cond)
+
+@torch.no_grad()
+def calibrate_segmentation(prepared_model, dl, num_batches = 32):
+    for ind, (images, _) in enumerate(dl):
+        if ind == num_batches:
+            break
+
+        prepared_model(to_float_images(images).cpu())
+
+# quantization entry points
+
+def quantize_diffusion(diffusion, dl, num_calibration_batches = 32, backend = 'x86'):
+    """
+    copy of the GaussianDiffusion with an int8 unet on cpu, calibrated on `dl`, a DataLoader over `Dataset`
+    the float unet is not copied
+    """
+    prepared = prepare_int8(diffusion.model, backend)
+    calibrate_diffusion(prepared, diffusion, dl, num_calibration_batches)
+    unet = convert_int8(prepared)
+
+    return copy.deepcopy(diffusion, memo = {id(diffusion.model): unet}).cpu()
+
+def quantize_segmentation(model, dl, num_calibration_batches = 32, backend = 'x86'):
+    """ int8 copy of a ResUNet on cpu, calibrated on `dl`, a DataLoader over `SegmentationtrainData` """
+    prepared = prepare_int8(model, backend)
+    calibrate_segmentation(prepared, dl, num_calibration_batches)
+    return convert_int8(prepared)
+
+# checkpoints
+
+def save_quantized(model, path, backend = 'x86'):
+    data = {
+        'model': model.state_dict(),
+        'backend': backend,
+        'torch': torch.__version__,
+        'version': __version__
+    }
+
+    torch.save(data, str(path))
+
+def load_quantized(model, path):
+    """
+    rebuilds the int8 model from `model`, the float model it was quantized from (only the architecture is used), and loads the checkpoint into it
+    """
+    data = torch.load(str(path), map_location = 'cpu', weights_only = False)
+
+    with warnings.catch_warnings():
+        # observers are not run, their placeholder quantization parameters are overwritten by the checkpoint
+        warnings.simplefilter('ignore')
+        quantized = convert_int8(prepare_int8(model, data['backend']))
+
+    quantized.load_state_dict(data['model'])
+    return quantized
+
+# accuracy reports
+
+@torch.no_grad()
+def diffusion_accuracy_report(diffusion, int8_diffusion, dl, num_batches = 8, num_samples = 64, batch_size = 16, inception_dims = 64, seed = 0):
+    """
+    compares an int8 GaussianDiffusion to the float one, on cpu, leaving the float one where it is
+
+    output_rel_error - relative l2 error of the int8 unet outputs on noised data batches
+    fid_proxy - frechet distance between inception features of float and int8 samples drawn from the same noise
+    the 64 dimensional inception features keep the covariance estimate stable at the small sample counts this is meant for
+    """
+    diffusion, int8_diffusion = copy.deepcopy(diffusion).cpu().eval(), int8_diffusion.eval()
+
+    errors, fp32_time, int8_time = [], 0., 0.
+
+    for ind, images in enumerate(dl):
+        if ind == num_batches:
+            break
+
+        x_start = diffusion.normalize(to_float_images(images).cpu())
+        t = torch.randint(0, diffusion.num_timesteps, (x_start.shape[0],), dtype = torch.long)
+        x = diffusion.q_sample(x_start, t)
+
+        out, elapsed = timed(diffusion.model, x, t)
+        int8_out, int8_elapsed = timed(int8_diffusion.model, x, t)
+
+        errors.append(((int8_out - out).norm() / out.norm()).item())
+        fp32_time += elapsed
+        int8_time += int8_elapsed
+
+    report = dict(
+        output_rel_error = float(np.mean(errors)),
+        speedup = fp32_time / int8_time
+    )
+
+    if num_samples == 0:
+        return report
+
+    inception = InceptionV3([InceptionV3.BLOCK_INDEX_BY_DIM[inception_dims]]).eval()
+
+    def sample_features(model):
+        torch.manual_seed(seed)
+        features = []
+
+        for start in range(0, num_samples, batch_size):
+            samples = model.sample(batch_size = min(batch_size, num_samples - start))
+
+            if samples.shape[1] == 1:
+                samples = samples.repeat(1, 3, 1, 1)
+
+            feats = inception(samples)[0]
+            feats = nn.functional.adaptive_avg_pool2d(feats, output_size = (1, 1))
+            features.append(rearrange(feats, '... 1 1 -> ...'))
+
+        return torch.cat(features).numpy()
+
+    fp32_features, int8_features = map(sample_features, (diffusion, int8_diffusion))
+
+    mu1, sigma1 = fp32_features.mean(axis = 0), np.cov(fp32_features, rowvar = False)
+    mu2, sigma2 = int8_features.mean(axis = 0), np.cov(int8_features, rowvar = False)
+
+    report.update(fid_proxy = float(calculate_frechet_distance(mu1, sigma1, mu2, sigma2)))
+    return report
+
+def confusion_matrix(pred, target, num_class):
+    valid = (target >= 0) & (target < num_class)
+    indices = target[valid] * num_class + pred[valid]
+    return torch.bincount(indices, minlength = num_class ** 2).reshape(num_class, num_class)
+
+def mean_iou(confusion):
+    intersection = confusion.diag().double()
+    union = confusion.sum(dim = 0) + confusion.sum(dim = 1) - confusion.diag()
+    present = union > 0
+    return (intersection[present] / union[present]).mean().item()
+
+@torch.no_grad()
+def segmentation_accuracy_report(model, int8_model, dl, num_class = 100, num_batches = None):
+    """
+    compares an int8 ResUNet to the float one on `dl`, a DataLoader over `SegmentationtrainData`, on cpu, leaving the float one where it is
+    mIoU is over the classes present in the predictions or labels, ignoring void and IGNORE_INDEX pixels
+    """
+    model, int8_model = copy.deepcopy(model).cpu().eval(), int8_model.eval()
+
+    confusion = torch.zeros(num_class, num_class, dtype = torch.long)
+    int8_confusion = torch.zeros_like(confusion)
+    agree, total, fp32_time, int8_time = 0, 0, 0., 0.
+
+    for ind, (images, labels) in enumerate(dl):
+        if exists(num_batches) and ind == num_batches:
+            break
+
+        images, labels = to_float_images(images).cpu(), labels.cpu().long()
+
+        logits, elapsed = timed(model, images)
+        int8_logits, int8_elapsed = timed(int8_model, images)
+
+        pred, int8_pred = logits.argmax(dim = 1), int8_logits.argmax(dim = 1)
+
+        confusion += confusion_matrix(pred, labels, num_class)
+        int8_confusion += confusion_matrix(int8_pred, labels, num_class)
+
+        agree += (pred == int8_pred).sum().item()
+        total += pred.numel()
+        fp32_time += elapsed
+        int8_time += int8_elapsed
+
+    return dict(
+        fp32_miou = mean_iou(confusion),
+        int8_miou = mean_iou(int8_confusion),
+        pixel_agreement = agree / total,
+        speedup = fp32_time / int8_time
+    )
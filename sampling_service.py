@@ -0,0 +1,217 @@
+import asyncio
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import torch
+from einops import rearrange
+
+from denoising_diffusion_pytorch.denoising_diffusion_pytorch import SamplingStep
+
+# helpers
+
+def exists(val):
+    return val is not None
+
+def default(val, d):
+    if exists(val):
+        return val
+    return d() if callable(d) else d
+
+# request state
+
+class SamplingRequest:
+    def __init__(self, num_images, seed, future, device):
+        self.num_images = num_images
+        self.future = future
+
+        self.generator = torch.Generator(device = device)
+
+        if exists(seed):
+            self.generator.manual_seed(seed)
+        else:
+            self.generator.seed()
+
+        self.step = 0
+        self.x = None
+        self.x_start = None
+
+# main class
+
+class SamplingService:
+    """
+    in-process asyncio serving layer around GaussianDiffusion
+
+    concurrent `sample` calls are merged into one batched denoising loop of at most `max_batch_size` images
+    requests arriving mid loop join at the next step boundary (continuous batching), so rows of one batch can be at different timesteps
+    every request keeps its own step counter and a seeded generator for its initial and per step noise
+
+    uses the ancestral or ddim sampling table of the diffusion model, as configured by its `sampling_timesteps`
+    """
+
+    def __init__(
+        self,
+        diffusion,
+        max_batch_size = 16
+    ):
+        assert diffusion.can_use_sampling_tables, 'the sampling service needs the precomputed sampling tables of GaussianDiffusion'
+
+        self.diffusion = diffusion.eval()
+        self.max_batch_size = max_batch_size
+
+        device = diffusion.device
+        (h, w), channels = diffusion.image_size, diffusion.channels
+        self.shape = (channels, h, w)
+
+        if diffusion.is_ddim_sampling:
+            table = diffusion.sampling_table(diffusion.sampling_timesteps, diffusion.ddim_sampling_eta)
+        else:
+            table = diffusion.sampling_table(ancestral = True)
+
+        # the sampling table as tensors, indexed by each row's step counter
+
+        self.num_steps = len(table)
+        self.times = torch.tensor([step.time for step in table], device = device, dtype = torch.long)
+        self.coefs = {name: torch.tensor([getattr(step, name) for step in table], device = device) for name in SamplingStep._fields[1:]}
+        self.has_noise = any(step.noise_scale > 0. for step in table)
+
+        # the unet's time conditioning is cached for the table's timesteps and only used within `step`
+        # it is recomputed there if a sampling run of the diffusion model cleared it or the weights changed
+
+        self.time_list = self.times.tolist()
+
+        self.pending = deque()
+        self.active = []
+
+        # the model runs on a single background thread so the event loop keeps accepting requests
+
+        self.executor = ThreadPoolExecutor(1)
+        self.worker = None
+        self.wakeup = None
+
+        self.stats = dict(steps = 0, rows = 0, completed = 0)
+
+    @property
+    def mean_batch_size(self):
+        return self.stats['rows'] / max(self.stats['steps'], 1)
+
+    async def sample(self, num_images = 1, seed = None):
+        assert 0 < num_images <= self.max_batch_size, f'a request can have at most {self.max_batch_size} images'
+
+        loop = asyncio.get_running_loop()
+
+        if not exists(self.worker) or self.worker.done():
+            self.wakeup = asyncio.Event()
+            self.worker = loop.create_task(self.run())
+
+        request = SamplingRequest(num_images, seed, loop.create_future(), self.diffusion.device)
+        self.pending.append(request)
+        self.wakeup.set()
+
+        return await request.future
+
+    async def close(self):
+        if exists(self.worker):
+            self.worker.cancel()
+
+            try:
+                await self.worker
+            except asyncio.CancelledError:
+                pass
+
+        # requests still waiting or in flight will not be served anymore
+
+        for request in (*self.pending, *self.active):
+            request.future.cancel()
+
+        self.pending.clear()
+        self.active = []
+
+        self.executor.shutdown()
+        self.diffusion.clear_time_cache()
+
+    def admit(self):
+        rows = sum(request.num_images for request in self.active)
+
+        while len(self.pending) > 0 and rows + self.pending[0].num_images <= self.max_batch_size:
+            request = self.pending.popleft()
+
+            if request.future.done():
+                continue
+
+            try:
+                request.x = torch.randn((request.num_images, *self.shape), generator = request.generator, device = self.diffusion.device)
+                request.x = request.x.contiguous(memory_format = self.diffusion.memory_format)
+            except Exception as e:
+                request.future.set_exception(e)
+                continue
+
+            self.active.append(request)
+            rows += request.num_images
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+
+        while True:
+            self.admit()
+
+            # requests whose caller stopped waiting, e.g. cancelled by a timeout, leave the batch
+
+            self.active = [request for request in self.active if not request.future.done()]
+
+            if len(self.active) == 0:
+                self.wakeup.clear()
+                await self.wakeup.wait()
+                continue
+
+            try:
+                await loop.run_in_executor(self.executor, self.step)
+            except Exception as e:
+                for request in self.active:
+                    if not request.future.done():
+                        request.future.set_exception(e)
+
+                self.active = []
+                continue
+
+            finished = [request for request in self.active if request.step == self.num_steps]
+            self.active = [request for request in self.active if request.step < self.num_steps]
+
+            for request in finished:
+                if not request.future.done():
+                    request.future.set_result(self.diffusion.unnormalize(request.x))
+
+                self.stats['completed'] += 1
+
+    @torch.inference_mode()
+    def step(self):
+        requests, device = self.active, self.diffusion.device
+        sizes = [request.num_images for request in requests]
+
+        x = torch.cat([request.x for request in requests])
+        step_index = torch.tensor([request.step for request in requests for _ in range(request.num_images)], device = device)
+
+        self_cond = None
+
+        if self.diffusion.self_condition:
+            self_cond = torch.cat([default(request.x_start, lambda: torch.zeros_like(request.x)) for request in requests])
+
+        with self.diffusion.time_cached(self.time_list):
+            model_output = self.diffusion.model(x, self.times[step_index], self_cond)
+
+        coef = lambda name: rearrange(self.coefs[name][step_index], 'b -> b 1 1 1')
+
+        x_start = model_output * coef('start_from_out') + x * coef('start_from_x')
+        x_start.clamp_(-1., 1.)
+
+        x_next = x_start * coef('next_from_start') + x * coef('next_from_x')
+
+        if self.has_noise:
+            noise = torch.cat([torch.randn(request.x.shape, generator = request.generator, device = device) for request in requests])
+            x_next = x_next + noise * coef('noise_scale')
+
+        for request, request_x, request_x_start in zip(requests, x_next.split(sizes), x_start.split(sizes)):
+            request.x, request.x_start = request_x, request_x_start
+            request.step += 1
+
+        self.stats['steps'] += 1
+        self.stats['rows'] += sum(sizes)